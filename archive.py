@@ -1,4 +1,5 @@
 from common import *
+import bisect, mmap, struct, sys
 
 
 class U8(WiiArchive):
@@ -17,9 +18,67 @@ class U8(WiiArchive):
 			self.name_offset = Struct.uint16
 			self.data_offset = Struct.uint32
 			self.size = Struct.uint32
+	class U8Extent(object):
+		# placeholder for file data that is still sitting in the source buffer
+		__slots__ = ('offset', 'size')
+		def __init__(self, offset, size):
+			self.offset = offset
+			self.size = size
 	def __init__(self):
-		self.files = []
-	def _dump(self):
+		self._files = []
+		self._index = {}
+		self._children = {'': []}
+		self._source = None
+		self._slots = None
+		self._dirty = set()
+	def _getFiles(self):
+		return self._files
+	def _setFiles(self, files):
+		self._files = files
+		self._reindex()
+	# (path, data) pairs in archive order; data is None for directories.
+	# Change entries through item assignment, del, rename() or by assigning
+	# a new list, so that the path index stays in sync.
+	files = property(_getFiles, _setFiles)
+	def _reindex(self):
+		# rebuilds the path -> position index and the directory tree
+		self._slots = None # the node table no longer matches what's on disk
+		self._index = {}
+		self._children = {'': []}
+		for i in range(len(self._files)):
+			item, value = self._files[i]
+			self._index[item] = i
+			self._link(item, value)
+	def _link(self, item, value):
+		if(value == None):
+			self._children.setdefault(item, [])
+		self._children.setdefault(item[:max(item.rfind('/'), 0)], []).append(item)
+	def _unlink(self, item):
+		self._children[item[:max(item.rfind('/'), 0)]].remove(item)
+	def loadFile(cls, filename, lazy=False):
+		if(not lazy):
+			return cls.load(open(filename, "rb").read())
+		f = open(filename, "rb")
+		try:
+			try:
+				data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except (ValueError, EnvironmentError): # empty files can't be mapped
+				data = f.read()
+		finally:
+			f.close()
+		return cls.load(data, lazy=True)
+	loadFile = classmethod(loadFile)
+	def close(self):
+		# releases the source mapping; lazy entries can't be read after this
+		if(isinstance(self._source, mmap.mmap)):
+			self._source.close()
+		self._source = None
+	def _data(self, value):
+		if(isinstance(value, self.U8Extent)):
+			return self._source[value.offset:value.offset + value.size]
+		return value
+	def _layout(self):
+		# works out every node and offset in one pass, without building the data
 		header = self.U8Header()
 		rootnode = self.U8Node()
 		
@@ -29,9 +88,15 @@ class U8(WiiArchive):
 		header.zeroes = "\x00" * 16
 		rootnode.type = 0x0100
 		
+		# a directory's size counts every path starting with its own path,
+		# so keep a sorted copy of the paths to count them with bisect
+		paths = sorted([item for item, value in self.files])
+		
 		nodes = []
-		strings = '\x00'
-		data = ''
+		strings = ['\x00']
+		stringsize = 1
+		files = []
+		datasize = 0
 		
 		for item, value in self.files:
 			node = self.U8Node()
@@ -41,45 +106,139 @@ class U8(WiiArchive):
 				recursion = 0
 			name = item[item.rfind('/') + 1:]
 			
-			node.name_offset = len(strings)
-			strings += name + '\x00'
+			node.name_offset = stringsize
+			strings.append(name + '\x00')
+			stringsize += len(name) + 1
 		
 			if(value == None): # directory
 				node.type = 0x0100
 				node.data_offset = recursion
-				
-				node.size = len(nodes) + 1
-				for one, two in self.files:
-					if(one[:len(item)] == item): # find nodes in the folder
-						node.size += 1
+				node.size = len(nodes) + 1 + _countPrefixed(paths, item)
 			else: # file
+				value = self._data(value)
 				node.type = 0x0000
-				node.data_offset = len(data)
-				#print "before: " + str(len(data))
-				data += value + ('\x00' * (align(len(value), 32) - len(value))) # 32 seems to work best for fuzzyness? I'm still really not sure
-				#print "after: " + str(len(data))
+				node.data_offset = datasize
 				node.size = len(value)
-				#print "sz: " + str(len(value))
+				files.append(value)
+				datasize += align(len(value), 32) # 32 seems to work best for fuzzyness? I'm still really not sure
 			nodes.append(node)
 			
-		header.header_size = ((len(nodes) + 1) * len(rootnode)) + len(strings)
+		header.header_size = ((len(nodes) + 1) * len(rootnode)) + stringsize
 		header.data_offset = align(header.header_size + header.rootnode_offset, 64)
 		rootnode.size = len(nodes) + 1
 		
-		for i in range(len(nodes)):
-			if(nodes[i].type == 0x0000):
-				nodes[i].data_offset += header.data_offset
-						
-		fd = ''
-		fd += header.pack()
-		fd += rootnode.pack()
 		for node in nodes:
-			fd += node.pack()
-		fd += strings
-		fd += "\x00" * (header.data_offset - header.rootnode_offset - header.header_size)
-		fd += data
+			if(node.type == 0x0000):
+				node.data_offset += header.data_offset
+		
+		return header, rootnode, nodes, ''.join(strings), files, header.data_offset + datasize
+	def write(self, f):
+		# streams the archive into a file object
+		header, rootnode, nodes, strings, files, size = self._layout()
+		
+		f.write(header.pack())
+		f.write(rootnode.pack() + ''.join([node.pack() for node in nodes]))
+		f.write(strings)
+		f.write("\x00" * (header.data_offset - header.rootnode_offset - header.header_size))
+		for value in files:
+			f.write(value)
+			f.write("\x00" * (align(len(value), 32) - len(value)))
+		
+		# remember where everything went, so later saves can patch f
+		slots = {}
+		for i in range(len(nodes)):
+			node = nodes[i]
+			if(node.type == 0x0000):
+				slots[self._files[i][0]] = [i + 1, node.name_offset, node.data_offset, align(node.size, 32)]
+		self._setSlots(slots, header.rootnode_offset, size)
+	def _setSlots(self, slots, rootnode_offset, size):
+		# slots maps each file to [node index, name offset, data offset, space]
+		self._slots = slots
+		self._slotsRoot = rootnode_offset
+		self._slotsEnd = size
+		self._slotsWasted = 0
+		self._dirty = set()
+	def patch(self, f):
+		# writes only the files changed since the archive was last loaded from
+		# or written to f, plus their nodes. Data that still fits in its old
+		# space is overwritten in place, anything bigger is moved to the end.
+		# Returns False without touching f if a full write() is needed
+		# instead: after adding, removing or renaming entries, or once too
+		# much of the file would be taken up by abandoned data.
+		if(self._slots == None):
+			return False
 		
-		return fd
+		end = self._slotsEnd
+		wasted = self._slotsWasted
+		plan = []
+		for item in sorted(self._dirty, key=self._index.get):
+			nodeindex, name_offset, offset, space = self._slots[item]
+			value = self._data(self._files[self._index[item]][1])
+			if(len(value) <= space):
+				plan.append((item, offset, space, value))
+			else:
+				wasted += space
+				offset = align(end, 32)
+				space = align(len(value), 32)
+				plan.append((item, offset, space, value))
+				end = offset + space
+		
+		if(wasted * 2 > end):
+			return False
+		
+		f.seek(0, 2)
+		size = f.tell()
+		if(size < self._slotsEnd):
+			return False # not the file we wrote
+		for item, offset, space, value in plan:
+			if(offset > size):
+				f.seek(size)
+				f.write("\x00" * (offset - size))
+			f.seek(offset)
+			f.write(value)
+			f.write("\x00" * (min(align(len(value), 32), space) - len(value)))
+			size = max(size, f.tell())
+			
+			slot = self._slots[item]
+			f.seek(self._slotsRoot + slot[0] * 12)
+			f.write(struct.pack('>HHLL', 0x0000, slot[1], offset, len(value)))
+			slot[2] = offset
+			slot[3] = space
+		
+		self._slotsEnd = end
+		self._slotsWasted = wasted
+		self._dirty = set()
+		return True
+	def dumpInto(self, buf=None):
+		# fills a preallocated bytearray (made here if it isn't passed in)
+		header, rootnode, nodes, strings, files, size = self._layout()
+		
+		if(buf == None):
+			buf = bytearray(size)
+		elif(len(buf) < size):
+			raise ValueError('buffer too small for archive (%d < %d)' % (len(buf), size))
+		
+		tables = header.pack() + rootnode.pack() + ''.join([node.pack() for node in nodes]) + strings
+		buf[0:len(tables)] = tables
+		buf[len(tables):header.data_offset] = "\x00" * (header.data_offset - len(tables))
+		offset = header.data_offset
+		for value in files:
+			end = offset + len(value)
+			padded = offset + align(len(value), 32)
+			buf[offset:end] = value
+			buf[end:padded] = "\x00" * (padded - end)
+			offset = padded
+		
+		return buf
+	def _dump(self):
+		return str(self.dumpInto())
+	def dumpFile(self, filename):
+		f = open(filename, "wb")
+		try:
+			self.write(f)
+		finally:
+			f.close()
+		return filename
 	def _dumpDir(self, dir):
 		if(not os.path.isdir(dir)):
 			os.mkdir(dir)
@@ -90,7 +249,7 @@ class U8(WiiArchive):
 				if(not os.path.isdir(item)):
 					os.mkdir(item)
 			else:
-				open(item, "wb").write(data)
+				open(item, "wb").write(self._data(data))
 		os.chdir(old)
 	def _loadDir(self, dir):
 		try:
@@ -110,32 +269,61 @@ class U8(WiiArchive):
 				self.files.append((self._tmpPath + entry, data))
 		os.chdir(old)
 		self._tmpPath = self._tmpPath[:self._tmpPath.find('/') + 1]
-	def _load(self, data):
-		offset = 0
-		
-		for i in range(len(data)):
-			header = self.U8Header()
-			header.unpack(data[offset:offset + len(header)])
-			if(header.tag == "U\xAA8-"):
-				break
-			data = data[1:]
-		offset += len(header)
-		offset = header.rootnode_offset
+		self._reindex()
+	def _checkHeader(cls, data, pos):
+		# sanity checks a possible header so stray tags in file data are skipped
+		if(pos < 0 or pos + 0x2C > len(data)):
+			return False
+		tag, rootnode_offset, header_size, data_offset = struct.unpack_from('>4sLLL', data, pos)
+		if(tag != "U\xAA8-" or rootnode_offset < 0x20):
+			return False
+		if(data_offset < rootnode_offset + header_size or pos + data_offset > len(data)):
+			return False
+		if(pos + rootnode_offset + 12 > len(data)):
+			return False
+		
+		roottype, rootname, rootdata, rootsize = struct.unpack_from('>HHLL', data, pos + rootnode_offset)
+		return roottype == 0x0100 and rootsize >= 1 and rootsize * 12 <= header_size
+	_checkHeader = classmethod(_checkHeader)
+	def locate(cls, data, start=0):
+		# offset of the first valid U8 header at or after start, or -1
+		pos = data.find("U\xAA8-", start)
+		while(pos != -1 and not cls._checkHeader(data, pos)):
+			pos = data.find("U\xAA8-", pos + 1)
+		return pos
+	locate = classmethod(locate)
+	def locateAll(cls, data):
+		# offsets of every U8 archive embedded in data, including ones stored
+		# inside other archives; pass one to load(data, offset=...) to open it
+		ret = []
+		pos = cls.locate(data)
+		while(pos != -1):
+			ret.append(pos)
+			pos = cls.locate(data, pos + 1)
+		return ret
+	locateAll = classmethod(locateAll)
+	def _load(self, data, lazy=False, offset=None):
+		if(offset == None):
+			offset = self.locate(data)
+			if(offset == -1):
+				raise ValueError('no U8 archive found')
+		base = offset
+		
+		header = self.U8Header()
+		header.unpack(data, base)
+		offset = base + header.rootnode_offset
 		
 		#print header.rootnode_offset
 		#print header.header_size
 		#print header.data_offset
 		
 		rootnode = self.U8Node()
-		rootnode.unpack(data[offset:offset + len(rootnode)])
+		rootnode.unpack(data, offset)
 		offset += len(rootnode)
 		
-		nodes = []
-		for i in range(rootnode.size - 1):
-			node = self.U8Node()
-			node.unpack(data[offset:offset + len(node)])
-			offset += len(node)
-			nodes.append(node)
+		# the whole node table in one go
+		nodes = self.U8Node.unpack_array(data, offset, rootnode.size - 1)
+		offset += len(rootnode) * len(nodes)
 		
 		strings = data[offset:offset + header.data_offset - len(header) - (len(rootnode) * rootnode.size)]
 		offset += len(strings)
@@ -145,7 +333,10 @@ class U8(WiiArchive):
 		counter = 0
 		for node in nodes:
 			counter += 1
-			name = strings[node.name_offset:].split('\0', 1)[0]
+			end = strings.find('\0', node.name_offset)
+			if(end == -1):
+				end = len(strings)
+			name = strings[node.name_offset:end]
 			
 			if(node.type == 0x0100): # folder
 				recursion.append(node.size)
@@ -155,7 +346,11 @@ class U8(WiiArchive):
 				
 				#print "Dir: " + name
 			elif(node.type == 0): # file
-				self.files.append(('/'.join(recursiondir) + '/' + name, data[node.data_offset:node.data_offset + node.size]))
+				if(lazy):
+					value = self.U8Extent(base + node.data_offset, node.size)
+				else:
+					value = data[base + node.data_offset:base + node.data_offset + node.size]
+				self.files.append(('/'.join(recursiondir) + '/' + name, value))
 				offset += node.size
 				
 				#print "File: " + name
@@ -172,6 +367,29 @@ class U8(WiiArchive):
 				recursion.append(sz)
 			else:
 				recursiondir.pop()
+		
+		if(lazy):
+			self._source = data
+		self._reindex()
+		
+		# files can be patched in place up to the start of the next one; files
+		# sharing an offset (or out of range) get no space and are always moved
+		if(base == 0 and len(self._files) == len(nodes)):
+			offsets = {}
+			for node in nodes:
+				if(node.type == 0):
+					offsets[node.data_offset] = offsets.get(node.data_offset, 0) + 1
+			ends = sorted(offsets.keys() + [len(data)])
+			slots = {}
+			for i in range(len(nodes)):
+				node = nodes[i]
+				if(node.type != 0):
+					continue
+				space = 0
+				if(node.data_offset < len(data) and offsets[node.data_offset] == 1):
+					space = ends[bisect.bisect_right(ends, node.data_offset)] - node.data_offset
+				slots[self._files[i][0]] = [i + 1, node.name_offset, node.data_offset, space]
+			self._setSlots(slots, header.rootnode_offset, len(data))
 	def __str__(self):
 		ret = ''
 		for key, value in self.files:
@@ -185,21 +403,83 @@ class U8(WiiArchive):
 			ret += '\n'
 		return ret
 	def __getitem__(self, key):
-		for item, val in self.files:
-			if(item == key):
-				if(val != None):
-					return val
-				else:
-					ret = []
-					for item2, val2 in self.files:
-						if(item2.find(item) == 0):
-							ret.append(item2[len(item) + 1:])
-					return ret[1:]
-		raise KeyError
-	def __setitem__(self, key, val):
-		for i in range(len(self.files)):
-			if(self.files[i][0] == key):
-				self.files[i] = (self.files[i][0], val)
-				return
-		self.files.append((key, val))
+		val = self._files[self._index[key]][1]
+		if(val != None):
+			return self._data(val)
 		
+		# directories give every path below them, relative to the directory
+		ret = []
+		self._walk(key, len(key) + 1, ret)
+		return ret
+	def _walk(self, dir, strip, ret):
+		for item in self._children[dir]:
+			ret.append(item[strip:])
+			if(item in self._children):
+				self._walk(item, strip, ret)
+	def __setitem__(self, key, val):
+		if(key in self._index):
+			i = self._index[key]
+			if(self._slots != None):
+				if(key not in self._slots or val == None):
+					self._slots = None
+				elif(self._data(self._files[i][1]) != val):
+					self._dirty.add(key)
+			self._files[i] = (key, val)
+			if(val == None):
+				self._children.setdefault(key, [])
+			elif(key in self._children and len(self._children[key]) == 0):
+				del self._children[key]
+			return
+		self._index[key] = len(self._files)
+		self._files.append((key, val))
+		self._link(key, val)
+		self._slots = None
+	def __delitem__(self, key):
+		# removes a file, or a directory along with everything in it
+		remove = set([key])
+		if(self.isdir(key)):
+			remove.update([key + '/' + item for item in self[key]])
+		self._files = [entry for entry in self._files if entry[0] not in remove]
+		self._reindex()
+	def __contains__(self, key):
+		return key in self._index
+	def get(self, key, default=None):
+		if(key in self._index):
+			return self[key]
+		return default
+	def rename(self, old, new):
+		# renames a file in place, keeping its position in the archive
+		if(self.isdir(old)):
+			raise ValueError('cannot rename directory %s' % old)
+		if(new in self._index):
+			raise ValueError('%s already exists' % new)
+		i = self._index.pop(old)
+		self._files[i] = (new, self._files[i][1])
+		self._index[new] = i
+		self._unlink(old)
+		self._link(new, self._files[i][1])
+		self._slots = None
+	def isdir(self, key):
+		return key in self._index and self._files[self._index[key]][1] == None
+	def listdir(self, dir=''):
+		# names of the entries directly inside a directory ('' is the root)
+		return [item[item.rfind('/') + 1:] for item in self._children[dir]]
+
+
+def _countPrefixed(paths, prefix):
+	# counts the entries in a sorted list that start with prefix
+	start = bisect.bisect_left(paths, prefix)
+	if(isinstance(prefix, unicode)):
+		char, maxchar = unichr, sys.maxunicode
+	else:
+		char, maxchar = chr, 0xFF
+	
+	if(prefix == '' or ord(prefix[-1]) == maxchar):
+		end = start
+		while(end < len(paths) and paths[end].startswith(prefix)):
+			end += 1
+		return end - start
+	
+	# everything starting with prefix sorts below this
+	limit = prefix[:-1] + char(ord(prefix[-1]) + 1)
+	return bisect.bisect_left(paths, limit, start) - start
@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: latin-1 -*-
+
+# Reggie! - New Super Mario Bros. Wii Level Editor
+# Copyright (C) 2009-2010 Treeki, Tempus
+
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+
+# blockcodec.py
+# Record layouts for the blocks inside a course file, decoded and encoded
+# a whole block at a time. NumPy is used when it's installed; otherwise
+# the same layouts go through one struct call per block.
+
+
+import struct
+
+try:
+    import numpy
+    HaveNumPy = True
+except ImportError:
+    HaveNumPy = False
+
+
+# struct codes -> NumPy type codes (without the byte order)
+NumPyTypes = {
+    'b': 'i1', 'B': 'u1',
+    'h': 'i2', 'H': 'u2',
+    'i': 'i4', 'I': 'u4',
+    'l': 'i4', 'L': 'u4',
+    'q': 'i8', 'Q': 'u8',
+    'f': 'f4', 'd': 'f8',
+    }
+
+
+class BlockCodec(object):
+    """Reads and writes a block made of fixed size records"""
+
+    def __init__(self, format, names):
+        """Creates a codec from a big endian struct format and a field name
+        for each value it holds (padding bytes don't get one)"""
+        self.format = format
+        self.names = tuple(names)
+        self.struct = struct.Struct(format)
+        self.size = self.struct.size
+
+        # work out where each field sits, for the NumPy dtype
+        formats = []
+        offsets = []
+        offset = 0
+        count = ''
+        for char in format[1:]:
+            if char.isdigit():
+                count += char
+                continue
+
+            n = int(count or '1')
+            count = ''
+            if char == 'x':
+                offset += n
+            elif char == 's':
+                # 'S' would strip trailing nulls from sprite data
+                formats.append('V%d' % n)
+                offsets.append(offset)
+                offset += n
+            else:
+                for i in xrange(n):
+                    formats.append(format[0] + NumPyTypes[char])
+                    offsets.append(offset)
+                    offset += struct.calcsize(format[0] + char)
+
+        if len(formats) != len(self.names):
+            raise ValueError('%s has %d fields but %d names' % (format, len(formats), len(self.names)))
+
+        if HaveNumPy:
+            self.dtype = numpy.dtype({'names': list(self.names), 'formats': formats, 'offsets': offsets, 'itemsize': self.size})
+
+            # rows are encoded through a copy with 64-bit integers first, so
+            # values that don't fit can be caught instead of wrapping around
+            wide = []
+            self.limits = []
+            for name, fmt in zip(self.names, formats):
+                if fmt[1] in 'iu':
+                    wide.append('i8')
+                    info = numpy.iinfo(fmt)
+                    self.limits.append((name, info.min, info.max))
+                else:
+                    wide.append(fmt)
+            self.wide = numpy.dtype({'names': list(self.names), 'formats': wide})
+        else:
+            self.dtype = None
+
+    def count(self, data):
+        """Returns how many whole records fit in a block"""
+        return len(data) // self.size
+
+    def array(self, data, count=None, offset=0):
+        """Returns the records as a NumPy structured array, for column
+        access (read-only if data is a string)"""
+        if count is None: count = (len(data) - offset) // self.size
+        return numpy.frombuffer(data, self.dtype, count, offset)
+
+    def decode(self, data, count=None, offset=0):
+        """Returns a list with a tuple of values for each record"""
+        if count is None: count = (len(data) - offset) // self.size
+        if count <= 0: return []
+
+        if HaveNumPy:
+            return self.array(data, count, offset).tolist()
+
+        values = struct.unpack_from(self.format + self.format[1:] * (count - 1), data, offset)
+        fields = len(self.names)
+        return [values[i:i+fields] for i in xrange(0, len(values), fields)]
+
+    def encode(self, rows, terminator=''):
+        """Packs a sequence of value tuples back into a block, followed by
+        terminator"""
+        if len(rows) == 0: return terminator
+
+        if HaveNumPy:
+            wide = numpy.zeros(len(rows), self.wide)
+            wide[:] = rows
+            for name, low, high in self.limits:
+                column = wide[name]
+                if column.min() < low or column.max() > high:
+                    # let struct raise the same error it always has
+                    values = []
+                    for row in rows: values.extend(row)
+                    return struct.pack(self.format + self.format[1:] * (len(rows) - 1), *values) + terminator
+
+            # padding bytes have to stay zeroed
+            array = numpy.zeros(len(rows), self.dtype)
+            array[:] = wide
+            return array.tobytes() + terminator
+
+        values = []
+        for row in rows: values.extend(row)
+        return struct.pack(self.format + self.format[1:] * (len(rows) - 1), *values) + terminator
+
+
+# block 3
+Bounding = BlockCodec('>llllxBxBxxxx', ('upper', 'lower', 'unk1', 'unk2', 'id', 'flags'))
+# blocks 5 and 6
+Background = BlockCodec('>xBhhhhHHHxxxBxxxx', ('id', 'xscroll', 'yscroll', 'ypos', 'xpos', 'bg1', 'bg2', 'bg3', 'zoom'))
+# block 7
+Entrance = BlockCodec('>HHxxxxBBBBxBBBHxx', ('x', 'y', 'id', 'destarea', 'destentrance', 'type', 'zone', 'layer', 'path', 'settings'))
+# block 8 - on the way out, byte 6 of the sprite data is replaced by the zone ID
+Sprite = BlockCodec('>HHH8sxx', ('type', 'x', 'y', 'data'))
+SpriteOut = BlockCodec('>HHH6sB1sxx', ('type', 'x', 'y', 'data', 'zone', 'data2'))
+# block 9
+LoadedSprite = BlockCodec('>Hxx', ('type',))
+# block 10
+Zone = BlockCodec('>HHHHHHBBBBxBBBBxBB', ('x', 'y', 'width', 'height', 'modeldark', 'terraindark', 'id', 'block3id', 'cammode', 'camzoom', 'visibility', 'block5id', 'block6id', 'unknown', 'music', 'sfxmod'))
+# block 11
+Location = BlockCodec('>HHHHBxxx', ('x', 'y', 'width', 'height', 'id'))
+# block 13
+Path = BlockCodec('>BxHHH', ('id', 'start', 'count', 'loops'))
+# block 14
+PathNode = BlockCodec('>HHffhxx', ('x', 'y', 'speed', 'accel', 'delay'))
+# bgdat layers
+Object = BlockCodec('>HHHHH', ('type', 'x', 'y', 'width', 'height'))
@@ -38,6 +38,30 @@ class Struct(object):
 	__endian__ = '<'
 	
 	def __init__(self, func=None, unpack=None, **kwargs):
+		compiled = None
+		if func == None:
+			compiled = self.compile()
+		
+		if compiled != None:
+			# the layout was already traced once for this class, so share it
+			codec, names, strings, defaults, self.__defs__, self.__sizes__, self.__attrs__ = compiled
+			self.__values__ = defaults.copy()
+			self.__next__ = True
+			self.__baked__ = True
+		else:
+			self.__build__(func)
+		
+		if unpack != None:
+			if isinstance(unpack, tuple):
+				self.unpack(*unpack)
+			else:
+				self.unpack(unpack)
+		
+		if len(kwargs):
+			for name in kwargs:
+				self.__values__[name] = kwargs[name]
+	
+	def __build__(self, func):
 		self.__defs__ = []
 		self.__sizes__ = []
 		self.__attrs__ = []
@@ -55,16 +79,93 @@ class Struct(object):
 				self.__setattr__(name, value)
 		
 		self.__baked__ = True
+	
+	def compile(cls):
+		# traces __format__ once per class and, if every field has a fixed
+		# size, turns the layout into a single struct.Struct. Returns
+		# (codec, names, strings, defaults, defs, sizes, attrs), or None for
+		# structs that have to go field by field (nested structs, arrays,
+		# strings sized by another field, native alignment)
+		if '__compiled__' in cls.__dict__:
+			return cls.__compiled__
 		
-		if unpack != None:
-			if isinstance(unpack, tuple):
-				self.unpack(*unpack)
+		cls.__compiled__ = None
+		layout = cls.__new__(cls)
+		layout.__build__(None)
+		if layout.__endian__ not in ('<', '>', '!'):
+			return None
+		
+		format = ''
+		names = []
+		strings = []
+		for i in range(len(layout.__defs__)):
+			sdef, size, attrs = layout.__defs__[i], layout.__sizes__[i], layout.__attrs__[i]
+			
+			if sdef == Struct.string:
+				size, offset, encoding, stripNulls, value = size
+				if isinstance(size, str) or attrs[0] == '*':
+					return None
+				format += '%ds' % size
+				if encoding != None or stripNulls:
+					strings.append((attrs, encoding, stripNulls))
+				names.append(attrs)
+			elif sdef == Struct:
+				return None
 			else:
-				self.unpack(unpack)
+				for name in attrs:
+					if name[0] == '*':
+						return None
+				format += sdef
+				names.extend(attrs)
 		
-		if len(kwargs):
-			for name in kwargs:
-				self.__values__[name] = kwargs[name]
+		codec = struct.Struct(layout.__endian__ + format)
+		cls.__compiled__ = (codec, names, strings, layout.__values__, layout.__defs__, layout.__sizes__, layout.__attrs__)
+		return cls.__compiled__
+	compile = classmethod(compile)
+	
+	def unpack_array(cls, data, offset, count):
+		# decodes count records stored back to back in data, starting at offset
+		compiled = cls.compile()
+		ret = []
+		if compiled == None:
+			for i in range(count):
+				item = cls()
+				item.unpack(data, offset)
+				offset += len(item)
+				ret.append(item)
+			return ret
+		
+		codec, names, strings, defaults, defs, sizes, attrs = compiled
+		if count <= 0:
+			return ret
+		if len(data) - offset < codec.size * count:
+			raise StructException('Expected %i bytes, got %i' % (codec.size * count, len(data) - offset))
+		
+		values = struct.unpack_from(codec.format[0] + codec.format[1:] * count, data, offset)
+		fields = len(names)
+		setslot = object.__setattr__
+		for i in range(0, len(values), fields):
+			item = cls.__new__(cls)
+			setslot(item, '__defs__', defs)
+			setslot(item, '__sizes__', sizes)
+			setslot(item, '__attrs__', attrs)
+			setslot(item, '__values__', dict(zip(names, values[i:i + fields])))
+			setslot(item, '__next__', True)
+			setslot(item, '__baked__', True)
+			if strings:
+				item.__decode__(strings)
+			ret.append(item)
+		return ret
+	unpack_array = classmethod(unpack_array)
+	
+	def __decode__(self, strings):
+		for name, encoding, stripNulls in strings:
+			temp = self.__values__[name]
+			if encoding != None:
+				temp = temp.decode(encoding)
+			if stripNulls:
+				temp = temp.rstrip('\0')
+			self.__values__[name] = temp
 	
 	def __trace__(self, frame, event, arg):
 		self.__frame__ = frame
@@ -166,6 +267,16 @@ class Struct(object):
 		return ret
 	
 	def unpack(self, data, pos=0):
+		compiled = self.__class__.__dict__.get('__compiled__')
+		if compiled != None and compiled[4] is self.__defs__:
+			codec, names, strings = compiled[:3]
+			if len(data) - pos < codec.size:
+				raise StructException('Expected %i bytes, got %i' % (codec.size, len(data) - pos))
+			self.__values__.update(zip(names, codec.unpack_from(data, pos)))
+			if strings:
+				self.__decode__(strings)
+			return self
+		
 		for name in self.__values__:
 			if not isinstance(self.__values__[name], Struct):
 				self.__values__[name] = None
@@ -230,6 +341,16 @@ class Struct(object):
 		return self
 	
 	def pack(self):
+		compiled = self.__class__.__dict__.get('__compiled__')
+		if compiled != None and compiled[4] is self.__defs__:
+			codec, names, strings = compiled[:3]
+			values = [self.__values__[name] for name in names]
+			for name, encoding, stripNulls in strings:
+				if encoding != None:
+					i = names.index(name)
+					values[i] = values[i].encode(encoding)
+			return codec.pack(*values)
+		
 		arraypos, arrayname = None, None
 		
 		ret = ''
@@ -329,9 +450,7 @@ class WiiHeader(object):
 
 
 def align(x, boundary):
-	while x % boundary != 0:
-		x += 1
-	return x
+	return x + (-x % boundary)
 	
 def clamp(var, min, max):
 	if var < min: var = min
@@ -1,4 +1,16 @@
-import struct
+import struct, sys, time
+
+# effort levels for LZS11.Compress
+LZ_FAST = 0		# greedy, short hash chains, long matches aren't indexed
+LZ_GREEDY = 1	# greedy, longer hash chains
+LZ_LAZY = 2		# checks whether the next byte starts a longer match first
+
+# level -> (max hash chain steps per search, lazy matching)
+_levels = {
+	LZ_FAST: (8, False),
+	LZ_GREEDY: (64, False),
+	LZ_LAZY: (256, True),
+}
 
 class LZS11(object):
 	def __init__(self):
@@ -7,6 +19,187 @@ class LZS11(object):
 		self.curr_size = 0
 		self.compressed = True
 		self.outdata = []
+	def Decompress( self , filein ):
+		# same format as Decompress11LZS, but works on bytearrays and copies
+		# back-references with slices; returns the data as a string, like
+		# nsmblib.decompress11LZS
+		data = bytearray(filein)
+		assert len(data) < ( 0x4000 * 0x4000 * 2 )
+		self.magic = data[0]
+		assert self.magic == 0x11
+		self.decomp_size = data[1] | (data[2] << 8) | (data[3] << 16)
+		offset = 4
+		if ( self.decomp_size == 0 ):
+			self.decomp_size = data[4] | (data[5] << 8) | (data[6] << 16) | (data[7] << 24)
+			offset += 4
+		assert self.decomp_size <= 0x200000 << 8
+
+		size = self.decomp_size
+		end = len(data)
+		out = bytearray(size)
+		curr = 0
+
+		while curr < size and offset < end:
+			flags = data[offset]
+			offset += 1
+
+			for x in (0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01):
+				if flags & x:
+					first = data[offset]
+					second = data[offset+1]
+					offset += 2
+
+					if first < 0x20:
+						third = data[offset]
+						offset += 1
+
+						if first >= 0x10:
+							fourth = data[offset]
+							offset += 1
+
+							pos = (((third & 0xF) << 8) | fourth) + 1
+							copylen = ((second << 4) | ((first & 0xF) << 12) | (third >> 4)) + 273
+						else:
+							pos = (((second & 0xF) << 8) | third) + 1
+							copylen = (((first & 0xF) << 4) | (second >> 4)) + 17
+					else:
+						pos = (((first & 0xF) << 8) | second) + 1
+						copylen = (first >> 4) + 1
+
+					if pos > curr:
+						raise ValueError('LZ11 back-reference before the start of the data')
+					if copylen > size - curr:
+						copylen = size - curr
+
+					src = curr - pos
+					if pos >= copylen:
+						out[curr:curr+copylen] = out[src:src+copylen]
+					else:
+						# overlapping, so the last pos bytes repeat
+						chunk = out[src:curr]
+						out[curr:curr+copylen] = (chunk * (copylen // pos + 1))[:copylen]
+					curr += copylen
+				else:
+					out[curr] = data[offset]
+					offset += 1
+					curr += 1
+
+				if offset >= end or curr >= size:
+					break
+
+		self.curr_size = curr
+		return str(out)
+	def Compress( self , filein , level=LZ_GREEDY ):
+		# finds matches in the 4 KB window using hash chains over every
+		# 3 byte sequence; returns the compressed data as a string
+		data = str(filein)
+		size = len(data)
+		depth, lazy = _levels[level]
+		window = 0x1000
+		maxlen = 0xFFFF + 273
+
+		out = bytearray()
+		if size == 0 or size > 0xFFFFFF:
+			out += struct.pack('<II', 0x11, size)
+		else:
+			out += struct.pack('<I', 0x11 | (size << 8))
+
+		head = {}			# 3 byte sequence -> last position it was seen at
+		prev = [-1] * size	# position -> previous position with the same sequence
+		state = [0]			# next position to add to the chains
+
+		def insert(upto):
+			pos = state[0]
+			last = min(upto, size - 2)
+			while pos < last:
+				key = data[pos:pos+3]
+				prev[pos] = head.get(key, -1)
+				head[key] = pos
+				pos += 1
+			if upto > pos:
+				pos = upto
+			state[0] = pos
+
+		def search(pos):
+			# returns (length, distance) of the longest match, or (0, 0)
+			insert(pos)
+			limit = min(maxlen, size - pos)
+			if limit < 3:
+				return 0, 0
+
+			bestlen, bestdist = 0, 0
+			cand = head.get(data[pos:pos+3], -1)
+			steps = depth
+			while cand >= 0 and pos - cand <= window and steps > 0:
+				steps -= 1
+				# quick reject: it can't be any better unless this byte matches
+				if data[cand+bestlen] == data[pos+bestlen]:
+					length = 3
+					chunk = 64
+					while chunk >= 1:
+						while length + chunk <= limit and data[cand+length:cand+length+chunk] == data[pos+length:pos+length+chunk]:
+							length += chunk
+						chunk >>= 3
+					if length > bestlen:
+						bestlen, bestdist = length, pos - cand
+						if length == limit:
+							break
+				cand = prev[cand]
+
+			return bestlen, bestdist
+
+		pos = 0
+		pending = None
+		flagpos = 0
+		bit = 0
+		while pos < size:
+			if bit == 0:
+				flagpos = len(out)
+				out.append(0)
+				bit = 0x80
+
+			if pending is not None:
+				length, dist = pending
+				pending = None
+			else:
+				length, dist = search(pos)
+
+			if lazy and length >= 3 and length < 128 and pos + 1 < size:
+				nextlen, nextdist = search(pos + 1)
+				if nextlen > length:
+					# a literal now lets the next match take over
+					length = 0
+					pending = (nextlen, nextdist)
+
+			if length >= 3:
+				out[flagpos] |= bit
+				d = dist - 1
+				if length <= 0xF + 1:
+					out.append(((length - 1) << 4) | (d >> 8))
+					out.append(d & 0xFF)
+				elif length <= 0xFF + 17:
+					l = length - 17
+					out.append(l >> 4)
+					out.append(((l & 0xF) << 4) | (d >> 8))
+					out.append(d & 0xFF)
+				else:
+					l = length - 273
+					out.append(0x10 | (l >> 12))
+					out.append((l >> 4) & 0xFF)
+					out.append(((l & 0xF) << 4) | (d >> 8))
+					out.append(d & 0xFF)
+
+				if level == LZ_FAST and length > 16:
+					# don't index the middle of long runs
+					state[0] = max(state[0], pos + length)
+				pos += length
+			else:
+				out.append(ord(data[pos]))
+				pos += 1
+
+			bit >>= 1
+
+		return str(out)
 	def Decompress11LZS( self , filein ):
 		offset = 0
 		# check that file is < 2GB
@@ -70,3 +263,38 @@ class LZS11(object):
 				if offset >= len(filein) or self.curr_size >= self.decomp_size:
 					break
 		return self.outdata
+
+
+def decompress11LZS(data):
+	return LZS11().Decompress(data)
+
+def compress11LZS(data, level=LZ_GREEDY):
+	return LZS11().Compress(data, level)
+
+
+if __name__ == '__main__':
+	# benchmark: python lz77.py file.LZ [...]
+	if len(sys.argv) < 2:
+		print 'usage: %s file.LZ [...]' % sys.argv[0]
+		sys.exit(1)
+
+	for name in sys.argv[1:]:
+		comp = open(name, 'rb').read()
+
+		start = time.clock()
+		old = LZS11().Decompress11LZS(comp)
+		oldtime = time.clock() - start
+
+		start = time.clock()
+		new = LZS11().Decompress(comp)
+		newtime = time.clock() - start
+
+		assert new == ''.join(map(chr, old)), 'output differs'
+		print '%s: %d -> %d bytes, Decompress11LZS %.3fs, Decompress %.3fs (%.1fx)' % (name, len(comp), len(new), oldtime, newtime, oldtime / max(newtime, 1e-6))
+
+		for level, label in ((LZ_FAST, 'fast'), (LZ_GREEDY, 'greedy'), (LZ_LAZY, 'lazy')):
+			start = time.clock()
+			recomp = compress11LZS(new, level)
+			comptime = time.clock() - start
+			assert decompress11LZS(recomp) == new, 'round trip failed'
+			print '    Compress (%s): %d bytes in %.3fs' % (label, len(recomp), comptime)
@@ -1,5 +1,4 @@
 #include <Python.h>
-#include "list.h"
 
 #define s32 signed int
 #define s16 signed short
@@ -27,9 +26,16 @@
  * 0.4: Added nsmblib_getVersion
  * 0.5: Added nsmblib_compress11LZS (thanks to puyo_tools
  *      for the original C# code)
+ * 0.6: Rewrote the compressor's dictionary using hash chains,
+ *      added a level parameter to nsmblib_compress11LZS
+ * 0.7: Added nsmblib_decompressedSize11LZS, nsmblib_decompress11LZSInto
+ *      and nsmblib_decodeTilesetInto, which take any buffer object;
+ *      decompressing and decoding no longer hold the GIL
+ * 0.8: Added an alpha flag to nsmblib_decodeTileset and
+ *      nsmblib_decodeTilesetInto for Reggie's -alpha option
  */
 
-#define CURRENT_VERSION 5
+#define CURRENT_VERSION 8
 
 static PyObject *nsmblib_getVersion(PyObject *self, PyObject *args) {
     /* Gets the current version of the NSMB module.
@@ -40,76 +46,129 @@ static PyObject *nsmblib_getVersion(PyObject *self, PyObject *args) {
      return Py_BuildValue("i", CURRENT_VERSION);
 }
 
-static PyObject *nsmblib_decompress11LZS(PyObject *self, PyObject *args) {
-    /* Decompresses a file using LZSS 0x11 variant.
-     * Returns: str (containing the decompressed data)
-     * Parameters:
-     *  - str data (containing the compressed data)
-     */
-    
-    const u8 *data;
-    int datalength;
-    
-    u8 *decoded;
-    PyObject *retvalue;
-    int decompsize;
+/* Buffer handling for the *Into functions: anything supporting the new
+ * buffer protocol (str, bytearray, memoryview...) or the old one (buffer,
+ * mmap, sip.voidptr from QImage.bits()) can be passed in. Only the new
+ * protocol locks the object while we hold its pointer, so the GIL is only
+ * released when every buffer involved has a view (see NSMBBuffer_locked). */
+
+typedef struct NSMBBuffer_t {
+#if PY_VERSION_HEX >= 0x02060000
+    Py_buffer view;
+#endif
+    int hasView;
+    void *buf;
+    Py_ssize_t len;
+} NSMBBuffer;
+
+static int NSMBBuffer_get(PyObject *obj, NSMBBuffer *b, int writable) {
+    /* returns -1 with an exception set on failure */
+    const void *readbuf;
+    
+    b->hasView = 0;
+    
+#if PY_VERSION_HEX >= 0x02060000
+    if (PyObject_CheckBuffer(obj)) {
+        if (PyObject_GetBuffer(obj, &b->view, writable ? PyBUF_WRITABLE : PyBUF_SIMPLE) < 0)
+            return -1;
+        b->hasView = 1;
+        b->buf = b->view.buf;
+        b->len = b->view.len;
+        return 0;
+    }
+#endif
     
-    /* used while decompressing */
-    int curr_size;
-    const u8 *source;
-    u8 *dest, *end;
-    int len, i, j, cdest, disp, flag;
-    u8 b1, b2, b3, bt, flags;
+    if (writable)
+        return PyObject_AsWriteBuffer(obj, &b->buf, &b->len);
     
-    /* get the arguments */
-    if (!PyArg_ParseTuple(args, "s#", &data, &datalength))
-        return NULL;
+    if (PyObject_AsReadBuffer(obj, &readbuf, &b->len) < 0)
+        return -1;
+    b->buf = (void*)readbuf;
+    return 0;
+}
+
+#define NSMBBuffer_locked(b) ((b)->hasView)
+
+static void NSMBBuffer_release(NSMBBuffer *b) {
+#if PY_VERSION_HEX >= 0x02060000
+    if (b->hasView)
+        PyBuffer_Release(&b->view);
+#endif
+    b->hasView = 0;
+}
+
+
+/* LZSS 0x11 decompression. These don't touch any Python objects, so
+ * they're safe to call with the GIL released. */
+
+static int LZ11_get_size(const u8 *data, int datalength, int *headersize) {
+    /* returns the decompressed size, or -1 if the header is invalid */
+    int decompsize = 0;
+    int i;
     
-    /* parse the file itself */
-    source = data;
-    if (*(source++) != 0x11) {
-        /* it's invalid */
-        Py_INCREF(Py_None);
-        return Py_None;
-    }
+    if (datalength < 4 || data[0] != 0x11)
+        return -1;
     
-    decompsize = 0;
     for (i = 0; i < 3; i++) {
-        decompsize += (*(source++)) << (i * 8);
+        decompsize += data[1 + i] << (i * 8);
     }
+    *headersize = 4;
     
     if (decompsize == 0) {
+        if (datalength < 8)
+            return -1;
         for (i = 0; i < 4; i++) {
-            decompsize += (*(source++)) << (i * 8);
+            decompsize += data[4 + i] << (i * 8);
         }
+        *headersize = 8;
     }
     
     /* if it's obviously invalid, kill it */
-    if (decompsize > 0x800000) {
+    if (decompsize < 0 || decompsize > 0x800000) {
         /* fixed 8mb limit */
-        PySys_WriteStdout("Too big! %d\n", decompsize);
-        Py_INCREF(Py_None);
-        return Py_None;
+        return -1;
     }
     
-    /* allocate a buffer */
-    decoded = (char*)PyMem_Malloc(decompsize);
-    if (decoded == NULL)
-        return PyErr_NoMemory();
+    return decompsize;
+}
+
+static int LZ11_decompress(const u8 *data, int datalength, u8 *decoded, int decompsize) {
+    /* decompresses into decoded, which must hold decompsize bytes;
+     * returns 0 on success or -1 if the data is corrupt */
+    int headersize;
+    
+    /* used while decompressing */
+    int curr_size;
+    const u8 *source, *source_end;
+    u8 *dest;
+    int len, i, j, cdest, disp, flag;
+    u8 b1, b2, b3, bt, flags;
+    
+    if (LZ11_get_size(data, datalength, &headersize) != decompsize)
+        return -1;
     
     /* now we can start going through everything */
+    source = data + headersize;
+    source_end = data + datalength;
     dest = decoded;
-    end = &decoded[decompsize];
     curr_size = 0;
     
     while (curr_size < decompsize) {
+        if (source >= source_end)
+            return -1;
         flags = *(source++);
         
         for (i = 0; i < 8 && curr_size < decompsize; i++) {
             flag = (flags & (0x80 >> i));
             if (flag > 0) {
+                if (source >= source_end)
+                    return -1;
                 b1 = *(source++);
                 
+                /* make sure the rest of the reference is there */
+                if (source + ((b1 >> 4) == 0 ? 2 : ((b1 >> 4) == 1 ? 3 : 1)) > source_end)
+                    return -1;
+                
                 switch (b1 >> 4) {
                     case 0:
                         len = b1 << 4;
@@ -143,11 +202,9 @@ static PyObject *nsmblib_decompress11LZS(PyObject *self, PyObject *args) {
                         break;
                 }
                 
-                if (disp > curr_size) {
+                if (disp >= curr_size) {
                     /* how's that for failure? */
-                    PyMem_Free(decoded);
-                    Py_INCREF(Py_None);
-                    return Py_None;
+                    return -1;
                 }
                 
                 cdest = curr_size;
@@ -156,22 +213,60 @@ static PyObject *nsmblib_decompress11LZS(PyObject *self, PyObject *args) {
                     *(dest++) = decoded[cdest - disp - 1 + j];
                     curr_size++;
                 }
-                
-                if (curr_size > decompsize) {
-                    break;
-                }
             } else {
+                if (source >= source_end)
+                    return -1;
                 *(dest++) = *(source++);
                 curr_size++;
-                
-                if (curr_size > decompsize) {
-                    break;
-                }
             }
         }
         
     }
     
+    return 0;
+}
+
+static PyObject *nsmblib_decompress11LZS(PyObject *self, PyObject *args) {
+    /* Decompresses a file using LZSS 0x11 variant.
+     * Returns: str (containing the decompressed data)
+     * Parameters:
+     *  - str data (containing the compressed data)
+     */
+    
+    const u8 *data;
+    int datalength;
+    
+    u8 *decoded;
+    PyObject *retvalue;
+    int decompsize, headersize, result;
+    
+    /* get the arguments */
+    if (!PyArg_ParseTuple(args, "s#", &data, &datalength))
+        return NULL;
+    
+    /* parse the file itself */
+    decompsize = LZ11_get_size(data, datalength, &headersize);
+    if (decompsize < 0) {
+        /* it's invalid */
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    
+    /* allocate a buffer */
+    decoded = (u8*)PyMem_Malloc(decompsize > 0 ? decompsize : 1);
+    if (decoded == NULL)
+        return PyErr_NoMemory();
+    
+    Py_BEGIN_ALLOW_THREADS
+    result = LZ11_decompress(data, datalength, decoded, decompsize);
+    Py_END_ALLOW_THREADS
+    
+    if (result < 0) {
+        PyMem_Free(decoded);
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    
     /* return it */
     retvalue = PyString_FromStringAndSize((const char*)decoded, decompsize);
     PyMem_Free(decoded);
@@ -179,186 +274,229 @@ static PyObject *nsmblib_decompress11LZS(PyObject *self, PyObject *args) {
     return retvalue;
 }
 
+static PyObject *nsmblib_decompressedSize11LZS(PyObject *self, PyObject *args) {
+    /* Reads the decompressed size from the header of LZSS 0x11 data.
+     * Returns: int, or None if the header is invalid
+     * Parameters:
+     *  - buffer data (containing the compressed data)
+     */
+    
+    PyObject *dataobj;
+    NSMBBuffer data;
+    int decompsize, headersize;
+    
+    if (!PyArg_ParseTuple(args, "O", &dataobj))
+        return NULL;
+    if (NSMBBuffer_get(dataobj, &data, 0) < 0)
+        return NULL;
+    
+    decompsize = LZ11_get_size((const u8*)data.buf, (int)data.len, &headersize);
+    NSMBBuffer_release(&data);
+    
+    if (decompsize < 0) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    return Py_BuildValue("i", decompsize);
+}
+
+static PyObject *nsmblib_decompress11LZSInto(PyObject *self, PyObject *args) {
+    /* Decompresses LZSS 0x11 data into an existing buffer, without
+     * holding the GIL while it works if both buffers support the new
+     * buffer protocol.
+     * Returns: int (the decompressed size), or None if the data is invalid
+     * Parameters:
+     *  - buffer data (containing the compressed data)
+     *  - writable buffer dest (at least decompressedSize11LZS(data) bytes)
+     */
+    
+    PyObject *dataobj, *destobj;
+    NSMBBuffer data, dest;
+    int decompsize, headersize, result;
+    
+    if (!PyArg_ParseTuple(args, "OO", &dataobj, &destobj))
+        return NULL;
+    if (NSMBBuffer_get(dataobj, &data, 0) < 0)
+        return NULL;
+    if (NSMBBuffer_get(destobj, &dest, 1) < 0) {
+        NSMBBuffer_release(&data);
+        return NULL;
+    }
+    
+    decompsize = LZ11_get_size((const u8*)data.buf, (int)data.len, &headersize);
+    if (decompsize >= 0 && dest.len < decompsize) {
+        NSMBBuffer_release(&data);
+        NSMBBuffer_release(&dest);
+        PyErr_Format(PyExc_ValueError, "destination buffer too small (%d < %d)", (int)dest.len, decompsize);
+        return NULL;
+    }
+    
+    result = -1;
+    if (decompsize >= 0) {
+        if (NSMBBuffer_locked(&data) && NSMBBuffer_locked(&dest)) {
+            Py_BEGIN_ALLOW_THREADS
+            result = LZ11_decompress((const u8*)data.buf, (int)data.len, (u8*)dest.buf, decompsize);
+            Py_END_ALLOW_THREADS
+        } else {
+            /* another thread could resize or free an old style buffer */
+            result = LZ11_decompress((const u8*)data.buf, (int)data.len, (u8*)dest.buf, decompsize);
+        }
+    }
+    
+    NSMBBuffer_release(&data);
+    NSMBBuffer_release(&dest);
+    
+    if (result < 0) {
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    return Py_BuildValue("i", decompsize);
+}
+
+/* LZ11 match finder: hash chains over 3 byte prefixes.
+ * head[] holds the newest position for each hash, and prev[] (a ring the
+ * size of the window) links each position to the previous one with the
+ * same hash, so nothing ever has to be removed from the dictionary. */
+
+#define LZ_WINDOW_SIZE 0x1000
+#define LZ_WINDOW_MASK (LZ_WINDOW_SIZE - 1)
+#define LZ_MIN_MATCH 3
+#define LZ_MAX_MATCH (0xFFFF + 273)
+#define LZ_HASH_BITS 15
+#define LZ_HASH_SIZE (1 << LZ_HASH_BITS)
+#define LZ_HASH(p) ((((p)[0] << 10) ^ ((p)[1] << 5) ^ (p)[2]) & (LZ_HASH_SIZE - 1))
+
+/* compression levels, same as the ones in lz77.py */
+#define LZ_FAST 0
+#define LZ_GREEDY 1
+#define LZ_LAZY 2
+
 typedef struct LZDict_t {
-    int WindowSize;
-    int WindowStart;
-    int WindowLength;
-    int MinMatchAmount;
-    int MaxMatchAmount;
-    int BlockSize;
-    IntList OffsetList[0x100];
+	int head[LZ_HASH_SIZE];
+	int prev[LZ_WINDOW_SIZE];
+	int next; /* next position to add to the chains */
+	int max_chain;
 } LZDict;
 
-void LZDict_init(LZDict *dict);
-void LZDict_free(LZDict *dict);
-void LZDict_search(LZDict *dict, u8 *data, int offset, int length, int *ret1, int *ret2);
-void LZDict_slide_window(LZDict *dict, int amount);
-void LZDict_slide_block(LZDict *dict);
-void LZDict_remove_old_entries(LZDict *dict, u8 index);
-void LZDict_set_window_size(LZDict *dict, int size);
-void LZDict_set_min_match_amount(LZDict *dict, int amount);
-void LZDict_set_max_match_amount(LZDict *dict, int amount);
-void LZDict_set_block_size(LZDict *dict, int size);
-void LZDict_add_entry(LZDict *dict, u8 *data, int offset);
-void LZDict_add_entry_range(LZDict *dict, u8 *data, int offset, int length);
-
-
-void LZDict_init(LZDict *dict) {
-	/* set up the dict */
-	int i;
-	for (i = 0; i < 0x100; i++) {
-		IntList_init(&(dict->OffsetList[i]));
-	}
-	
-	dict->WindowSize = 0x1000;
-	dict->WindowStart = 0;
-	dict->WindowLength = 0;
-	dict->MinMatchAmount = 3;
-	dict->MaxMatchAmount = 18;
-	dict->BlockSize = 0;
-}
+void LZDict_init(LZDict *dict, int max_chain);
+void LZDict_insert(LZDict *dict, const u8 *data, int length, int upto);
+void LZDict_search(LZDict *dict, const u8 *data, int offset, int length, int *ret1, int *ret2);
+
 
-void LZDict_free(LZDict *dict) {
-	/* free the dict */
+void LZDict_init(LZDict *dict, int max_chain) {
 	int i;
-	for (i = 0; i < 0x100; i++) {
-		IntList_free(&(dict->OffsetList[i]));
-	}
+	for (i = 0; i < LZ_HASH_SIZE; i++)
+		dict->head[i] = -1;
+	dict->next = 0;
+	dict->max_chain = max_chain;
 }
 
-void LZDict_search(LZDict *dict, u8 *data, int offset, int length, int *ret1, int *ret2) {
-	int i;
-	int MatchStart;
-	int MatchSize;
+void LZDict_insert(LZDict *dict, const u8 *data, int length, int upto) {
+	/* adds every position before upto to the chains */
+	int pos = dict->next;
+	int last = length - (LZ_MIN_MATCH - 1);
+	int h;
 	
-	LZDict_remove_old_entries(dict, data[offset]);
+	if (upto < last)
+		last = upto;
 	
-	if (offset < dict->MinMatchAmount || length - offset < dict->MinMatchAmount) {
-		*ret1 = 0;
-		*ret2 = 0;
-		return;
+	for (; pos < last; pos++) {
+		h = LZ_HASH(&data[pos]);
+		dict->prev[pos & LZ_WINDOW_MASK] = dict->head[h];
+		dict->head[h] = pos;
 	}
 	
-	// start finding matches
+	if (upto > dict->next)
+		dict->next = upto;
+}
+
+void LZDict_search(LZDict *dict, const u8 *data, int offset, int length, int *ret1, int *ret2) {
+	/* finds the longest match for offset in the window;
+	 * ret1 is the distance back and ret2 the length (0 if none) */
+	int limit = length - offset;
+	int steps = dict->max_chain;
+	int cand, size;
+	const u8 *cur = &data[offset];
+	
 	*ret1 = 0;
 	*ret2 = 0;
 	
-	for (i = dict->OffsetList[data[offset]].Count - 1; i >= 0; i--) {
-		MatchStart = dict->OffsetList[data[offset]].Elements[i];
-		MatchSize = 1;
-		
-		while (MatchSize < dict->MaxMatchAmount && MatchSize < dict->WindowLength && MatchStart + MatchSize < offset && offset + MatchSize < length && data[offset + MatchSize] == data[MatchStart + MatchSize])
-			MatchSize++;
-		
-		if (MatchSize >= dict->MinMatchAmount && MatchSize > *ret2) {
-			// this is a good match
-			*ret1 = offset - MatchStart;
-			*ret2 = MatchSize;
-			if (MatchSize == dict->MaxMatchAmount)
-				break; // don't look for more matches
-		}
-	}
-}
-
-void LZDict_slide_window(LZDict *dict, int amount) {
-	if (dict->WindowLength == dict->WindowSize)
-		dict->WindowStart += amount;
-	else {
-		if (dict->WindowLength + amount <= dict->WindowSize)
-			dict->WindowLength += amount;
-		else {
-			amount -= (dict->WindowSize - dict->WindowLength);
-			dict->WindowLength = dict->WindowSize;
-			dict->WindowStart += amount;
-		}
-	}
-}
-
-void LZDict_slide_block(LZDict *dict) {
-	dict->WindowStart += dict->BlockSize;
-}
-
-void LZDict_remove_old_entries(LZDict *dict, u8 index) {
-	int i;
+	LZDict_insert(dict, data, length, offset);
+	
+	if (limit > LZ_MAX_MATCH)
+		limit = LZ_MAX_MATCH;
+	if (limit < LZ_MIN_MATCH)
+		return;
 	
-	for (i = 0; i < dict->OffsetList[index].Count;) { // don't increment i
-		if (dict->OffsetList[index].Elements[i] >= dict->WindowStart)
-			break;
-		else
-			IntList_removeAt(&(dict->OffsetList[index]), 0);
+	cand = dict->head[LZ_HASH(cur)];
+	while (cand >= 0 && offset - cand <= LZ_WINDOW_SIZE && steps-- > 0) {
+		/* quick reject: it can't be any better unless this byte matches */
+		if (data[cand + *ret2] == cur[*ret2]) {
+			size = 0;
+			while (size < limit && data[cand + size] == cur[size])
+				size++;
+			
+			if (size >= LZ_MIN_MATCH && size > *ret2) {
+				*ret1 = offset - cand;
+				*ret2 = size;
+				if (size == limit)
+					break; /* can't do any better */
+			}
+		}
+		
+		cand = dict->prev[cand & LZ_WINDOW_MASK];
 	}
 }
 
-void LZDict_set_window_size(LZDict *dict, int size) {
-	dict->WindowSize = size;
-}
-
-void LZDict_set_min_match_amount(LZDict *dict, int amount) {
-	dict->MinMatchAmount = amount;
-}
-
-void LZDict_set_max_match_amount(LZDict *dict, int amount) {
-	dict->MaxMatchAmount = amount;
-}
-
-void LZDict_set_block_size(LZDict *dict, int size) {
-	dict->BlockSize = size;
-	dict->WindowLength = size;
-}
-
-void LZDict_add_entry(LZDict *dict, u8 *data, int offset) {
-	IntList_add(&(dict->OffsetList[data[offset]]), offset);
-}
-
-void LZDict_add_entry_range(LZDict *dict, u8 *data, int offset, int length) {
-	int i;
-	for (i = 0; i < length; i++)
-		IntList_add(&(dict->OffsetList[data[offset]]), offset + i);
-}
-
 static PyObject *nsmblib_compress11LZS(PyObject *self, PyObject *args) {
     /* Compresses a file using LZSS 0x11 variant.
      * Returns: str (containing the compressed data)
      * Parameters:
      *  - str data (containing the decompressed data)
+     *  - int level (optional: 0 = fast, 1 = greedy (default), 2 = lazy)
      */
     
     const u8 *data;
     int datalength;
+    int level = LZ_GREEDY;
     
-    u8 *src_ptr;
     u8 *dest_ptr;
-    
-    u8 *end_src_ptr;
-    
     u8 *buffer;
     int bufSize;
     
     PyObject *retvalue;
-    int i, ret1, ret2; // used in the compression loop
-    LZDict dict;
+    int offset, bit, dist, len, next1, next2;
+    int pending1, pending2, havePending;
+    u8 *flagpos;
+    LZDict *dict;
     
     /* get the arguments */
-    if (!PyArg_ParseTuple(args, "s#", &data, &datalength))
+    if (!PyArg_ParseTuple(args, "s#|i", &data, &datalength, &level))
+        return NULL;
+    
+    if (level < LZ_FAST || level > LZ_LAZY) {
+        PyErr_SetString(PyExc_ValueError, "level must be 0, 1 or 2");
         return NULL;
+    }
     
-    /* allocate a buffer to start with */
-    bufSize = datalength;
-    buffer = (char*)PyMem_Malloc(bufSize);
+    /* worst case: every byte is a literal, plus a flag byte for every 8 */
+    bufSize = 8 + datalength + (datalength / 8) + 1;
+    buffer = (u8*)PyMem_Malloc(bufSize);
     if (buffer == NULL)
         return PyErr_NoMemory();
     
-    src_ptr = (u8*)data;
-    dest_ptr = buffer;
+    dict = (LZDict*)PyMem_Malloc(sizeof(LZDict));
+    if (dict == NULL) {
+        PyMem_Free(buffer);
+        return PyErr_NoMemory();
+    }
     
-    end_src_ptr = (u8*)data + datalength;
+    LZDict_init(dict, (level == LZ_FAST) ? 8 : ((level == LZ_GREEDY) ? 64 : 256));
     
-    LZDict_init(&dict);
-    LZDict_set_window_size(&dict, 0x1000);
-    LZDict_set_max_match_amount(&dict, 0xFFFF + 273);
+    dest_ptr = buffer;
     
     /* write the decomp size */
-    if (datalength <= 0xFFFFFF) {
+    if (datalength > 0 && datalength <= 0xFFFFFF) {
 		*dest_ptr++ = 0x11;
 		*dest_ptr++ = (datalength & 0xFF);
 		*dest_ptr++ = ((datalength >> 8) & 0xFF);
@@ -375,55 +513,70 @@ static PyObject *nsmblib_compress11LZS(PyObject *self, PyObject *args) {
     }
     
     /* start compression */
-    while (src_ptr < end_src_ptr) {
-		u8 flag = 0;
-		u8 *flagpos = dest_ptr;
-		*dest_ptr++ = flag;
+    offset = 0;
+    bit = 0;
+    flagpos = NULL;
+    havePending = 0;
+    pending1 = pending2 = 0;
+    
+    while (offset < datalength) {
+		if (bit == 0) {
+			flagpos = dest_ptr;
+			*dest_ptr++ = 0;
+			bit = 0x80;
+		}
+		
+		if (havePending) {
+			dist = pending1;
+			len = pending2;
+			havePending = 0;
+		} else {
+			LZDict_search(dict, data, offset, datalength, &dist, &len);
+		}
+		
+		if (level == LZ_LAZY && len >= LZ_MIN_MATCH && len < 128 && offset + 1 < datalength) {
+			LZDict_search(dict, data, offset + 1, datalength, &next1, &next2);
+			if (next2 > len) {
+				/* a literal now lets the next match take over */
+				len = 0;
+				pending1 = next1;
+				pending2 = next2;
+				havePending = 1;
+			}
+		}
 		
-		for (i = 7; i >= 0; i--) {
-			LZDict_search(&dict, data, src_ptr - data, datalength, &ret1, &ret2);
-			if (ret2 > 0) { /* there is a compression match */
-				flag |= (u8)(1 << i);
-				
-				/* write the distance/length pair */
-				if (ret2 <= 0xF + 1) { /* 2 bytes */
-					*dest_ptr++ = (((ret2 - 1) & 0xF) << 4) | (((ret1 - 1) & 0xFFF) >> 8);
-					*dest_ptr++ = ((ret1 - 1) & 0xFF);
-				} else if (ret2 <= 0xFF + 17) { /* 3 bytes */
-					*dest_ptr++ = (((ret2 - 17) & 0xFF) >> 4);
-					*dest_ptr++ = ((((ret2 - 17) & 0xF) << 4) | (((ret1 - 1) & 0xFFF) >> 8));
-					*dest_ptr++ = ((ret1 - 1) & 0xFF);
-				} else { /* 4 bytes */
-					*dest_ptr++ = ((1 << 4) | (((ret2 - 273) & 0xFFFF) >> 12));
-					*dest_ptr++ = (((ret2 - 273) & 0xFFF) >> 4);
-					*dest_ptr++ = ((((ret2 - 273) & 0xF) << 4) | (((ret1 - 1) & 0xFFF) >> 8));
-					*dest_ptr++ = ((ret1 - 1) & 0xFF);
-				}
-				
-				LZDict_add_entry_range(&dict, data, src_ptr - data, ret2);
-				LZDict_slide_window(&dict, ret2);
-				
-				src_ptr += ret2;
-				
-			} else { /* there wasn't a match */
-				flag |= (u8)(0 << i);
-				
-				LZDict_add_entry(&dict, data, src_ptr - data);
-				LZDict_slide_window(&dict, 1);
-				
-				*dest_ptr++ = *src_ptr++;
+		if (len >= LZ_MIN_MATCH) { /* there is a compression match */
+			*flagpos |= bit;
+			
+			/* write the distance/length pair */
+			if (len <= 0xF + 1) { /* 2 bytes */
+				*dest_ptr++ = (((len - 1) & 0xF) << 4) | (((dist - 1) & 0xFFF) >> 8);
+				*dest_ptr++ = ((dist - 1) & 0xFF);
+			} else if (len <= 0xFF + 17) { /* 3 bytes */
+				*dest_ptr++ = (((len - 17) & 0xFF) >> 4);
+				*dest_ptr++ = ((((len - 17) & 0xF) << 4) | (((dist - 1) & 0xFFF) >> 8));
+				*dest_ptr++ = ((dist - 1) & 0xFF);
+			} else { /* 4 bytes */
+				*dest_ptr++ = ((1 << 4) | (((len - 273) & 0xFFFF) >> 12));
+				*dest_ptr++ = (((len - 273) & 0xFFF) >> 4);
+				*dest_ptr++ = ((((len - 273) & 0xF) << 4) | (((dist - 1) & 0xFFF) >> 8));
+				*dest_ptr++ = ((dist - 1) & 0xFF);
 			}
 			
-			/* check for out of bounds */
-			if (src_ptr >= end_src_ptr)
-				break;
+			/* don't index the middle of long runs in fast mode */
+			if (level == LZ_FAST && len > 16 && dict->next < offset + len)
+				dict->next = offset + len;
+			
+			offset += len;
+			
+		} else { /* there wasn't a match */
+			*dest_ptr++ = data[offset++];
 		}
 		
-		/* write the flag */
-		*flagpos = flag;
+		bit >>= 1;
     }
     
-    LZDict_free(&dict);
+    PyMem_Free(dict);
     
     /* return it! */
     retvalue = PyString_FromStringAndSize((const char*)buffer, dest_ptr - buffer);
@@ -432,44 +585,22 @@ static PyObject *nsmblib_compress11LZS(PyObject *self, PyObject *args) {
     return retvalue;
 }
 
-static PyObject *nsmblib_decodeTileset(PyObject *self, PyObject *args) {
-    /* Decodes an uncompressed RGB5A4 tileset into ARGB32 Premultiplied.
-     * Assumes that the size of the decoded tileset is 1024x512.
-     * Returns: str (containing the decoded data)
-     * Parameters:
-     *  - str texture (containing the raw texture data)
-     */
-    
-    const char *texture;
-    int texlength;
-    u8 *decoded;
-    PyObject *retvalue;
+#define TILESET_TEXTURE_SIZE 524288
+#define TILESET_DECODED_SIZE 1048576
+
+static void decode_tileset(const char *texture, unsigned int *output, int alpha) {
+    /* Decodes a 1024x256 RGB4A3 texture into ARGB32 Premultiplied pixels.
+     * If alpha is 0, the alpha bits are ignored and every pixel is opaque.
+     * Doesn't touch any Python objects, so it's safe without the GIL. */
     
     /* used later in the pixel loop */
     const char *pointer;
-    unsigned int *output;
     int tx, ty, i;
     
-    /* get the arguments */
-    if (!PyArg_ParseTuple(args, "s#", &texture, &texlength))
-        return NULL;
-    
-    if (texlength < 524288) {
-        /* if the input string is too small, return None */
-        Py_INCREF(Py_None);
-        return Py_None;
-    }
-    
-    /* allocate memory */
-    decoded = (char*)PyMem_Malloc(1048576);
-    if (decoded == NULL)
-        return PyErr_NoMemory();
-    
     /* loop through every tile */
     tx = 0;
     ty = 0;
     pointer = texture;
-    output = (int*)decoded;
     
     for (i = 0; i < 16384; i++) {
         /* loop through every row in this tile */
@@ -488,23 +619,27 @@ static PyObject *nsmblib_decodeTileset(PyObject *self, PyObject *args) {
                 char a = *(pointer++);
                 char b = *(pointer++);
                 
-                if ((a & 0x80) == 0) {
+                if ((a & 0x80) == 0 && !alpha) {
+                    /* RGB4 with the alpha ignored (the -alpha option) */
+                    output[pos] = 0xFF000000 | ((a & 0xF) << 20) | ((b & 0xF0) << 8) | ((b & 0xF) << 4);
+                    
+                } else if ((a & 0x80) == 0) {
                     /* use alpha */
-                    char alpha = (a & 0x70) << 1;
-                    unsigned int x = (alpha << 24) | ((a & 0xF) << 20) | ((b & 0xF0) << 8) | ((b & 0xF) << 4);
+                    char a8 = (a & 0x70) << 1;
+                    unsigned int argb = (a8 << 24) | ((a & 0xF) << 20) | ((b & 0xF0) << 8) | ((b & 0xF) << 4);
                     
                     /* this code from Qt's PREMUL() inline function in
                      * src/gui/painting/qdrawhelper_p.h */
-                    unsigned int al = x >> 24;
-                    unsigned int t = (x & 0xff00ff) * al;
+                    unsigned int al = argb >> 24;
+                    unsigned int t = (argb & 0xff00ff) * al;
                     t = (t + ((t >> 8) & 0xff00ff) + 0x800080) >> 8;
                     t &= 0xff00ff;
-                    x = ((x >> 8) & 0xff) * al;
-                    x = (x + ((x >> 8) & 0xff) + 0x80);
-                    x &= 0xff00;
-                    x |= t | (al << 24);
+                    argb = ((argb >> 8) & 0xff) * al;
+                    argb = (argb + ((argb >> 8) & 0xff) + 0x80);
+                    argb &= 0xff00;
+                    argb |= t | (al << 24);
                     
-                    output[pos] = x;
+                    output[pos] = argb;
                     
                 } else {
                     /* no alpha */
@@ -520,23 +655,115 @@ static PyObject *nsmblib_decodeTileset(PyObject *self, PyObject *args) {
             ty += 4;
         }
     }
+}
+
+static PyObject *nsmblib_decodeTileset(PyObject *self, PyObject *args) {
+    /* Decodes an uncompressed RGB5A4 tileset into ARGB32 Premultiplied.
+     * Assumes that the size of the decoded tileset is 1024x512.
+     * Returns: str (containing the decoded data)
+     * Parameters:
+     *  - str texture (containing the raw texture data)
+     *  - bool alpha (optional, default True: False makes every pixel opaque)
+     */
+    
+    const char *texture;
+    int texlength;
+    int alpha = 1;
+    u8 *decoded;
+    PyObject *retvalue;
+    
+    /* get the arguments */
+    if (!PyArg_ParseTuple(args, "s#|i", &texture, &texlength, &alpha))
+        return NULL;
+    
+    if (texlength < TILESET_TEXTURE_SIZE) {
+        /* if the input string is too small, return None */
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+    
+    /* allocate memory */
+    decoded = (u8*)PyMem_Malloc(TILESET_DECODED_SIZE);
+    if (decoded == NULL)
+        return PyErr_NoMemory();
+    
+    Py_BEGIN_ALLOW_THREADS
+    decode_tileset(texture, (unsigned int*)decoded, alpha);
+    Py_END_ALLOW_THREADS
     
     /* return it */
-    retvalue = PyString_FromStringAndSize(decoded, 1048576);
+    retvalue = PyString_FromStringAndSize((const char*)decoded, TILESET_DECODED_SIZE);
     PyMem_Free(decoded);
     
     return retvalue;
 }
 
+static PyObject *nsmblib_decodeTilesetInto(PyObject *self, PyObject *args) {
+    /* Decodes an uncompressed RGB5A4 tileset into an existing buffer
+     * (such as the bits of a 1024x256 ARGB32 Premultiplied QImage),
+     * without holding the GIL while it works if both buffers support the
+     * new buffer protocol.
+     * Returns: bool (False if the texture is too small)
+     * Parameters:
+     *  - buffer texture (containing the raw texture data)
+     *  - writable buffer dest (at least 1048576 bytes)
+     *  - bool alpha (optional, default True: False makes every pixel opaque)
+     */
+    
+    PyObject *texobj, *destobj;
+    NSMBBuffer texture, dest;
+    int ok;
+    int alpha = 1;
+    
+    if (!PyArg_ParseTuple(args, "OO|i", &texobj, &destobj, &alpha))
+        return NULL;
+    if (NSMBBuffer_get(texobj, &texture, 0) < 0)
+        return NULL;
+    if (NSMBBuffer_get(destobj, &dest, 1) < 0) {
+        NSMBBuffer_release(&texture);
+        return NULL;
+    }
+    
+    if (dest.len < TILESET_DECODED_SIZE) {
+        NSMBBuffer_release(&texture);
+        NSMBBuffer_release(&dest);
+        PyErr_Format(PyExc_ValueError, "destination buffer too small (%d < %d)", (int)dest.len, TILESET_DECODED_SIZE);
+        return NULL;
+    }
+    
+    ok = (texture.len >= TILESET_TEXTURE_SIZE);
+    if (ok) {
+        if (NSMBBuffer_locked(&texture) && NSMBBuffer_locked(&dest)) {
+            Py_BEGIN_ALLOW_THREADS
+            decode_tileset((const char*)texture.buf, (unsigned int*)dest.buf, alpha);
+            Py_END_ALLOW_THREADS
+        } else {
+            /* another thread could resize or free an old style buffer */
+            decode_tileset((const char*)texture.buf, (unsigned int*)dest.buf, alpha);
+        }
+    }
+    
+    NSMBBuffer_release(&texture);
+    NSMBBuffer_release(&dest);
+    
+    return PyBool_FromLong(ok);
+}
+
 static PyMethodDef NSMBLibMethods[] = {
     {"getVersion", nsmblib_getVersion, METH_VARARGS,
      "Gets the current version of the NSMB module."},
     {"decompress11LZS", nsmblib_decompress11LZS, METH_VARARGS,
      "Decompresses a file using LZSS 0x11 variant."},
+    {"decompressedSize11LZS", nsmblib_decompressedSize11LZS, METH_VARARGS,
+     "Reads the decompressed size from the header of LZSS 0x11 data."},
+    {"decompress11LZSInto", nsmblib_decompress11LZSInto, METH_VARARGS,
+     "Decompresses LZSS 0x11 data into a writable buffer, releasing the GIL."},
     {"compress11LZS", nsmblib_compress11LZS, METH_VARARGS,
-     "Compresses a file using LZSS 0x11 variant."},
+     "Compresses a file using LZSS 0x11 variant (optional level: 0 = fast, 1 = greedy, 2 = lazy)."},
     {"decodeTileset", nsmblib_decodeTileset, METH_VARARGS,
      "Decodes an uncompressed RGB5A4 tileset into ARGB32 Premultiplied."},
+    {"decodeTilesetInto", nsmblib_decodeTilesetInto, METH_VARARGS,
+     "Decodes an uncompressed RGB5A4 tileset into a writable buffer, releasing the GIL."},
     {NULL, NULL, 0, NULL}
 };
 
@@ -3,11 +3,11 @@ from distutils.extension import Extension
 
 setup(
   name='nsmblib',
-  version='0.5',
+  version='0.8',
   ext_modules=[
     Extension(
       'nsmblib',
-      ['nsmblibmodule.c', 'list.c'],
+      ['nsmblibmodule.c'],
     )
   ]
 )
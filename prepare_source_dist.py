@@ -14,6 +14,7 @@ shutil.copy('license.txt', dir)
 shutil.copy('readme.txt', dir)
 shutil.copy('reggie.py', dir)
 shutil.copy('archive.py', dir)
+shutil.copy('blockcodec.py', dir)
 shutil.copy('common.py', dir)
 shutil.copy('lz77.py', dir)
 shutil.copy('sprites.py', dir)
@@ -20,6 +20,7 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
 import archive
+import blockcodec
 import lz77
 import os.path
 import pickle
@@ -28,7 +29,9 @@ import struct
 import sys
 import time
 import warnings
+import zlib
 
+from array import array
 from ctypes import create_string_buffer
 from PyQt4 import QtCore, QtGui
 from xml.dom import minidom
@@ -43,6 +46,9 @@ if QtCompatVersion < 0x40600 or not hasattr(QtGui.QGraphicsItem, 'ItemSendsGeome
     # enables itemChange being called on QGraphicsItem
     QtGui.QGraphicsItem.ItemSendsGeometryChanges = QtGui.QGraphicsItem.GraphicsItemFlag(0x800)
 
+# Qt 4.7 can draw many pieces of one pixmap in a single call
+HavePixmapFragments = hasattr(QtGui.QPainter, 'drawPixmapFragments')
+
 # use psyco for optimisation if available
 try:
     import psyco
@@ -57,6 +63,13 @@ try:
 except ImportError:
     HaveNSMBLib = False
 
+# numpy speeds up texture decoding when nsmblib isn't there
+try:
+    import numpy
+    HaveNumPy = True
+except ImportError:
+    HaveNumPy = False
+
 
 app = None
 mainWindow = None
@@ -548,6 +561,201 @@ Tiles = None # 256 tiles per tileset, plus 64 for each type of override
 Overrides = None # 320 tiles, this is put into Tiles usually
 TileBehaviours = None
 ObjectDefinitions = None # 4 tilesets
+TilesetMemory = None # TilesetCache shared by all slots
+TilesetQueue = None # TilesetLoader for background loads
+TileChunkMemory = 128 * 1048576 # budget for TileChunkCache, in bytes
+
+TileSizes = [24, 12, 6, 3, 1] # size of a tile at each level of detail
+
+# how much of a tile is covered
+TileClear = 0
+TileMixed = 1
+TileOpaque = 2
+
+class Tile():
+    """A 24x24 tile inside an atlas pixmap"""
+
+    def __init__(self, atlas, x, y, shrunk=None, opacity=TileMixed):
+        """Constructor; shrunk is a result from ShrinkTiles"""
+        self.atlas = atlas
+        self.x = x
+        self.y = y
+        self.rect = QtCore.QRectF(x, y, 24, 24)
+        self.opacity = opacity
+
+        # (atlas, rect) for each level of detail, then the average colour
+        self.sources = [(atlas, self.rect)]
+        self.colour = None
+        if shrunk != None:
+            self.sources += shrunk[0]
+            self.colour = shrunk[1]
+
+    def draw(self, painter, x, y):
+        """Draws the tile with its top left corner at x, y"""
+        painter.drawPixmap(x, y, self.atlas, self.x, self.y, 24, 24)
+
+
+def ShrinkTiles(img, positions):
+    """Makes the smaller copies of tiles that are drawn when zoomed out.
+    Returns ([(atlas, rect) at 12, 6 and 3 pixels], average colour) for the
+    24x24 tile at each position in the image."""
+    count = len(positions)
+    rows = (count + 15) // 16
+
+    # pack the tiles together so each halving averages pixels from one tile
+    packed = QtGui.QImage(384, rows * 24, QtGui.QImage.Format_ARGB32_Premultiplied)
+    packed.fill(QtCore.Qt.transparent)
+    p = QtGui.QPainter(packed)
+    p.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+    for i, (x, y) in enumerate(positions):
+        p.drawImage((i % 16) * 24, (i // 16) * 24, img, x, y, 24, 24)
+    p.end()
+
+    atlases = []
+    shrunk = packed
+    for size in TileSizes[1:]:
+        shrunk = shrunk.scaled(size * 16, size * rows, QtCore.Qt.IgnoreAspectRatio, QtCore.Qt.SmoothTransformation)
+        atlases.append(shrunk)
+
+    result = []
+    colours = atlases.pop()
+    atlases = [QtGui.QPixmap.fromImage(atlas) for atlas in atlases]
+    for i in xrange(count):
+        tx = i % 16; ty = i // 16
+        sources = [(atlas, QtCore.QRectF(tx * size, ty * size, size, size)) for atlas, size in zip(atlases, TileSizes[1:4])]
+        result.append((sources, QtGui.QColor.fromRgba(colours.pixel(tx, ty))))
+
+    return result
+
+
+def TileOpacity(img, positions):
+    """Returns TileClear, TileMixed or TileOpaque for the 24x24 tile at each
+    position in the image, going by whether its alpha is all 0 or all 0xFF"""
+    if img.format() != QtGui.QImage.Format_ARGB32_Premultiplied:
+        img = img.convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+
+    stride = img.bytesPerLine()
+    bits = img.bits()
+    bits.setsize(img.byteCount())
+    data = bits.asstring()
+
+    # ARGB32 pixels are stored as native endian integers
+    if sys.byteorder == 'little':
+        alpha = 3
+    else:
+        alpha = 0
+
+    result = []
+    for x, y in positions:
+        opaque = 0
+        clear = 0
+        start = y*stride + x*4 + alpha
+        for row in xrange(24):
+            values = data[start:start+96:4]
+            opaque += values.count('\xFF')
+            clear += values.count('\0')
+            start += stride
+
+        if opaque == 576:
+            result.append(TileOpaque)
+        elif clear == 576:
+            result.append(TileClear)
+        else:
+            result.append(TileMixed)
+
+    return result
+
+
+def CullTiles(windows):
+    """Takes windows of tiles from the bottom layer up and returns copies
+    without the clear tiles or the ones hidden by an opaque tile on a layer
+    above them"""
+    tiles = Tiles
+    covered = [[False] * len(row) for row in windows[0]]
+    culled = []
+
+    for window in reversed(windows):
+        rows = []
+        for row, cover in zip(window, covered):
+            row = list(row)
+            for x, tile in enumerate(row):
+                if tile < 0: continue
+
+                t = tiles[tile]
+                if cover[x] or t == None or t.opacity == TileClear:
+                    row[x] = -1
+                elif t.opacity == TileOpaque:
+                    cover[x] = True
+            rows.append(row)
+        culled.append(rows)
+
+    culled.reverse()
+    return culled
+
+
+def TileDetail(zoom):
+    """Returns the level of detail for a zoom percentage: the smallest tile
+    size that still has a pixel for each pixel on screen"""
+    size = 24 * zoom / 100.0
+    lod = 0
+    while lod < 4 and TileSizes[lod+1] >= size: lod += 1
+    return lod
+
+
+def DrawTiles(painter, tilemap, lod=0):
+    """Draws rows of tile numbers onto a grid starting at 0,0; negative
+    numbers are skipped. The grid is TileSizes[lod] pixels wide. With Qt 4.7,
+    the tiles from each atlas are drawn in one call."""
+    tiles = Tiles
+    size = TileSizes[lod]
+
+    if lod == 4:
+        # each tile is one pixel of its average colour
+        fillRect = painter.fillRect
+        for y, row in enumerate(tilemap):
+            for x, tile in enumerate(row):
+                if tile >= 0:
+                    t = tiles[tile]
+                    if t != None: fillRect(x, y, 1, 1, t.colour)
+        return
+
+    if not HavePixmapFragments:
+        drawPixmap = painter.drawPixmap
+        QPointF = QtCore.QPointF
+        y = 0
+        for row in tilemap:
+            x = 0
+            for tile in row:
+                if tile >= 0:
+                    t = tiles[tile]
+                    if t != None:
+                        atlas, rect = t.sources[lod]
+                        drawPixmap(QPointF(x, y), atlas, rect)
+                x += size
+            y += size
+        return
+
+    # fragments are positioned by their centre
+    create = QtGui.QPainter.PixmapFragment.create
+    QPointF = QtCore.QPointF
+    batches = {}
+    y = size / 2.0
+    for row in tilemap:
+        x = size / 2.0
+        for tile in row:
+            if tile >= 0:
+                t = tiles[tile]
+                if t != None:
+                    atlas, rect = t.sources[lod]
+                    key = id(atlas)
+                    if key not in batches: batches[key] = (atlas, [])
+                    batches[key][1].append(create(QPointF(x, y), rect))
+            x += size
+        y += size
+
+    for atlas, fragments in batches.itervalues():
+        painter.drawPixmapFragments(fragments, atlas)
+
 
 class ObjectDef():
     """Class for the object definitions"""
@@ -559,12 +767,12 @@ class ObjectDef():
         self.rows = []
 
     def load(self, source, offset, tileoffset):
-        """Load an object definition"""
+        """Load an object definition from a bytearray"""
         i = offset
         row = []
 
         while True:
-            cbyte = ord(source[i])
+            cbyte = source[i]
 
             if cbyte == 0xFE:
                 self.rows.append(row)
@@ -576,124 +784,350 @@ class ObjectDef():
                 row.append((cbyte,))
                 i += 1
             else:
-                extra = ord(source[i+2])
-                tile = (cbyte, ord(source[i+1]) | ((extra & 3) << 8), extra >> 2)
+                extra = source[i+2]
+                tile = (cbyte, source[i+1] | ((extra & 3) << 8), extra >> 2)
                 row.append(tile)
                 i += 3
 
+    def compile(self):
+        """Works out everything needed to render the object from the rows, so
+        that rendering doesn't have to look at them again. This has to be
+        called again if the rows are changed."""
+        self.empty = (len(self.rows) == 0)
+        self.diagonal = False
+        if self.empty: return
+
+        if len(self.rows[0]) > 0 and (self.rows[0][0][0] & 0x80) != 0:
+            # diagonal objects are rendered differently
+            cbyte = self.rows[0][0][0]
+            self.diagonal = True
+            self.goLeft = ((cbyte & 1) != 0)
+            self.goDown = ((cbyte & 2) != 0)
+            self.mainBlock, self.subBlock = GetSlopeSections(self)
+            return
 
-def RenderObject(tileset, objnum, width, height, fullslope=False):
-    """Render a tileset object into an array"""
-    # allocate an array
-    dest = []
-    for i in xrange(height): dest.append([0]*width)
-
-    # ignore non-existent objects
-    tileset_defs = ObjectDefinitions[tileset]
-    if tileset_defs == None: return dest
-    obj = tileset_defs[objnum]
-    if obj == None: return dest
-    if len(obj.rows) == 0: return dest
-
-    # diagonal objects are rendered differently
-    if (obj.rows[0][0][0] & 0x80) != 0:
-        RenderDiagonalObject(dest, obj, width, height, fullslope)
-    else:
-        # standard object
+        # standard object: rows and the tiles in them are split into the
+        # parts before, inside and after the repeating section. Rows are
+        # stored once in rowtiles and the row sections refer to them by
+        # index.
+        self.rowtiles = []
+        sections = ([], [], [])
         repeatFound = False
-        beforeRepeat = []
-        inRepeat = []
-        afterRepeat = []
 
-        for row in obj.rows:
+        for row in self.rows:
             if len(row) == 0: continue
             if (row[0][0] & 2) != 0:
                 repeatFound = True
-                inRepeat.append(row)
+                section = 1
             else:
-                if repeatFound:
-                    afterRepeat.append(row)
-                else:
-                    beforeRepeat.append(row)
+                section = 2 if repeatFound else 0
 
-        bc = len(beforeRepeat); ic = len(inRepeat); ac = len(afterRepeat)
-        if ic == 0:
-            for y in xrange(height):
-                RenderStandardRow(dest[y], beforeRepeat[y % bc], y, width)
-        else:
-            afterthreshold = height - ac - 1
-            for y in xrange(height):
-                if y < bc:
-                    RenderStandardRow(dest[y], beforeRepeat[y], y, width)
-                elif y > afterthreshold:
-                    RenderStandardRow(dest[y], afterRepeat[y - height + ac], y, width)
-                else:
-                    RenderStandardRow(dest[y], inRepeat[(y - bc) % ic], y, width)
+            sections[section].append(len(self.rowtiles))
+            self.rowtiles.append(CompileStandardRow(row))
 
-    return dest
+        self.before, self.repeat, self.after = sections
+        self.empty = (len(self.rowtiles) == 0)
+
+        # resizing only changes the rows and columns from the repeating part
+        # onwards, as long as the object is big enough for every section
+        self.tailWidth = 0
+        self.fixedWidth = 0
+        for before, repeat, after in self.rowtiles:
+            self.tailWidth = max(self.tailWidth, len(after))
+            if len(repeat) > 0:
+                self.fixedWidth = max(self.fixedWidth, len(before) + len(after))
 
+        self.tailHeight = len(self.after)
+        self.fixedHeight = 0
+        if len(self.repeat) > 0:
+            self.fixedHeight = len(self.before) + len(self.after)
 
-def RenderStandardRow(dest, row, y, width):
-    """Render a row from an object"""
+
+def CompileStandardRow(row):
+    """Splits an object row into its before, inside and after repeat sections
+    of tile numbers"""
+    sections = (array('H'), array('H'), array('H'))
     repeatFound = False
-    beforeRepeat = []
-    inRepeat = []
-    afterRepeat = []
 
     for tile in row:
         if (tile[0] & 1) != 0:
             repeatFound = True
-            inRepeat.append(tile)
+            sections[1].append(tile[1])
+        elif repeatFound:
+            sections[2].append(tile[1])
         else:
-            if repeatFound:
-                afterRepeat.append(tile)
-            else:
-                beforeRepeat.append(tile)
+            sections[0].append(tile[1])
+
+    return sections
+
+
+def RepeatSections(before, repeat, after, length):
+    """Lays out the before, inside and after repeat sections of a row or
+    column over a length. If there's no repeating part, the before section is
+    repeated instead."""
+    bc = len(before)
+    ic = len(repeat)
 
-    bc = len(beforeRepeat); ic = len(inRepeat); ac = len(afterRepeat)
     if ic == 0:
-        for x in xrange(width):
-            dest[x] = beforeRepeat[x % bc][1]
-    else:
-        afterthreshold = width - ac - 1
-        for x in xrange(width):
-            if x < bc:
-                dest[x] = beforeRepeat[x][1]
-            elif x > afterthreshold:
-                dest[x] = afterRepeat[x - width + ac][1]
-            else:
-                dest[x] = inRepeat[(x - bc) % ic][1]
+        if bc == 0: return before[:0]
+        return (before * (length // bc + 1))[:length]
 
+    if length <= bc: return before[:length]
+
+    ac = len(after)
+    start = max(bc, length - ac)
+    count = start - bc
+    return before + (repeat * (count // ic + 1))[:count] + after[start - length + ac:]
+
+
+def ResizeSections(old, length, before, repeat, after):
+    """Works out the same layout as RepeatSections from one made for another
+    length, only filling in the part that changed. Returns None if the
+    sections don't fit in one of the lengths."""
+    oldlength = len(old)
+    if length == oldlength: return old
+
+    bc = len(before)
+    ic = len(repeat)
+
+    if ic == 0:
+        # the before section just keeps repeating
+        if length < oldlength or bc == 0: return old[:length]
+        return old + tuple([before[x % bc] for x in xrange(oldlength, length)])
+
+    ac = len(after)
+    if oldlength < bc + ac or length < bc + ac: return None
+
+    split = oldlength - ac
+    if length < oldlength:
+        return old[:length - ac] + old[split:]
+    return old[:split] + tuple([repeat[(x - bc) % ic] for x in xrange(split, length - ac)]) + old[split:]
 
-def RenderDiagonalObject(dest, obj, width, height, fullslope):
-    """Render a diagonal object"""
-    # set all to empty tiles
-    for row in dest:
-        for x in xrange(width):
-            row[x] = -1
 
-    # get sections
-    mainBlock,subBlock = GetSlopeSections(obj)
-    cbyte = obj.rows[0][0][0]
+def ResizedPrefix(old, new, fixed, tail):
+    """Returns how many rows or columns at the start of an object stay the
+    same when it's resized"""
+    shorter = min(old, new)
+    if shorter < fixed: return 0
+    return max(shorter - tail, 0)
 
-    # get direction
-    goLeft = ((cbyte & 1) != 0)
-    goDown = ((cbyte & 2) != 0)
+
+def TileRectToScene(rect):
+    """Returns the scene rect covering an (x1, y1, x2, y2) rect of tiles"""
+    x1, y1, x2, y2 = rect
+    return QtCore.QRectF(x1 * 24, y1 * 24, (x2 - x1) * 24, (y2 - y1) * 24)
+
+
+def GetObjectDef(tileset, objnum):
+    """Returns the definition of an object, or None if it doesn't exist"""
+    tileset_defs = ObjectDefinitions[tileset]
+    if tileset_defs == None: return None
+    return tileset_defs[objnum]
+
+
+def RenderObject(tileset, objnum, width, height, fullslope=False):
+    """Render a tileset object into an array"""
+    # ignore non-existent objects
+    obj = GetObjectDef(tileset, objnum)
+    if obj == None or obj.empty:
+        return [[0]*width for i in xrange(height)]
+
+    # diagonal objects are rendered differently
+    if obj.diagonal:
+        dest = [[-1]*width for i in xrange(height)]
+        RenderDiagonalObject(dest, obj, width, height, fullslope)
+        return dest
+
+    # standard object
+    rows = [RepeatSections(b, i, a, width) for b, i, a in obj.rowtiles]
+    return [rows[y].tolist() for y in RepeatSections(obj.before, obj.repeat, obj.after, height)]
+
+
+class RecentlyUsed():
+    """A dict that remembers the order its keys were last set or touched in,
+    for the caches to drop the least recently used entries. The order is a
+    linked list of [previous, next, key, value] links, so every operation
+    takes the same time however big it gets."""
+
+    def __init__(self):
+        """Constructor"""
+        self.clear()
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __iter__(self):
+        """Goes through the keys, least recently used first"""
+        root = self.root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    def __getitem__(self, key):
+        return self.links[key][3]
+
+    def get(self, key, default=None):
+        """Returns the value for a key without touching it"""
+        link = self.links.get(key)
+        if link is None: return default
+        return link[3]
+
+    def __setitem__(self, key, value):
+        """Sets a key, which becomes the most recently used"""
+        if key in self.links: self.pop(key)
+
+        root = self.root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = link
+        root[0] = link
+        self.links[key] = link
+
+    def __delitem__(self, key):
+        self.pop(key)
+
+    def pop(self, key):
+        """Removes a key and returns its value"""
+        link = self.links.pop(key)
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        return link[3]
+
+    def touch(self, key):
+        """Makes a key the most recently used and returns its value"""
+        value = self.pop(key)
+        self[key] = value
+        return value
+
+    def oldest(self):
+        """Returns the least recently used key"""
+        return self.root[1][2]
+
+    def popOldest(self):
+        """Removes the least recently used key, returning (key, value)"""
+        key = self.oldest()
+        return key, self.pop(key)
+
+    def clear(self):
+        """Removes everything"""
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.links = {}
+
+
+class RenderedObjectCache():
+    """Remembers recently rendered objects, so objects with the same tileset,
+    type and size share one read-only tile array"""
+
+    def __init__(self, limit):
+        """Constructor; limit is how many renders to keep"""
+        self.limit = limit
+        self.entries = RecentlyUsed()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tileset, type, width, height, fullslope=False):
+        """Returns the tiles for an object as a tuple of row tuples"""
+        key = (tileset, type, width, height, fullslope)
+        entries = self.entries
+
+        if key in entries:
+            self.hits += 1
+            return entries.touch(key)
+
+        self.misses += 1
+        data = self.render(tileset, type, width, height, fullslope)
+        if len(entries) >= self.limit: entries.popOldest()
+
+        entries[key] = data
+        return data
+
+    def resize(self, tileset, type, data, width, height):
+        """Returns the tiles for an object being resized to a new size; data
+        is what it had at its old size, which is reused where possible"""
+        key = (tileset, type, width, height, False)
+        obj = GetObjectDef(tileset, type)
+        if data == None or key in self.entries or obj == None or obj.empty or obj.diagonal:
+            return self.get(tileset, type, width, height)
+
+        self.misses += 1
+
+        # resize each distinct row once; rows that weren't visible at the
+        # old size are rendered from scratch
+        rowtiles = obj.rowtiles
+        rows = [None] * len(rowtiles)
+        for y, i in enumerate(RepeatSections(obj.before, obj.repeat, obj.after, len(data))):
+            if rows[i] == None:
+                before, repeat, after = rowtiles[i]
+                rows[i] = ResizeSections(data[y], width, before, repeat, after)
+
+        for i in xrange(len(rowtiles)):
+            if rows[i] == None:
+                before, repeat, after = rowtiles[i]
+                rows[i] = tuple(RepeatSections(before, repeat, after, width))
+
+        data = tuple([rows[i] for i in RepeatSections(obj.before, obj.repeat, obj.after, height)])
+
+        entries = self.entries
+        if len(entries) >= self.limit: entries.popOldest()
+        entries[key] = data
+        return data
+
+    def render(self, tileset, type, width, height, fullslope):
+        """Renders an object, sharing identical rows"""
+        obj = GetObjectDef(tileset, type)
+        if obj == None or obj.empty or obj.diagonal:
+            return tuple([tuple(row) for row in RenderObject(tileset, type, width, height, fullslope)])
+
+        rows = [tuple(RepeatSections(b, i, a, width)) for b, i, a in obj.rowtiles]
+        return tuple([rows[y] for y in RepeatSections(obj.before, obj.repeat, obj.after, height)])
+
+    def invalidate(self, tileset):
+        """Forgets everything rendered from one tileset slot"""
+        entries = self.entries
+        for key in [key for key in entries if key[0] == tileset]:
+            del entries[key]
+
+    def clear(self):
+        """Forgets everything"""
+        self.entries.clear()
+
+RenderedObjects = RenderedObjectCache(4096)
+
+
+def RenderDiagonalObject(dest, obj, width, height, fullslope):
+    """Render a diagonal object"""
+    mainBlock = obj.mainBlock
+    subBlock = obj.subBlock
+    goLeft = obj.goLeft
+    goDown = obj.goDown
+
+    mainWidth, mainRows = mainBlock
+    mainHeight = len(mainRows)
+    if subBlock != None:
+        subWidth, subRows = subBlock
+        subHeight = len(subRows)
+    else:
+        subHeight = 0
 
     # base the amount to draw by seeing how much we can fit in each direction
     if fullslope:
-        drawAmount = max(height // len(mainBlock), width // len(mainBlock[0]))
+        drawAmount = max(height // mainHeight, width // mainWidth)
     else:
-        drawAmount = min(height // len(mainBlock), width // len(mainBlock[0]))
+        drawAmount = min(height // mainHeight, width // mainWidth)
 
     # if it's not goingLeft and not goingDown:
     if not goLeft and not goDown:
         # slope going from SW => NE
         # start off at the bottom left
         x = 0
-        y = height - len(mainBlock) - (0 if subBlock == None else len(subBlock))
-        xi = len(mainBlock[0])
-        yi = -len(mainBlock)
+        y = height - mainHeight - subHeight
+        xi = mainWidth
+        yi = -mainHeight
 
     # ... and if it's goingLeft and not goingDown:
     elif goLeft and not goDown:
@@ -701,55 +1135,50 @@ def RenderDiagonalObject(dest, obj, width, height, fullslope):
         # start off at the top left
         x = 0
         y = 0
-        xi = len(mainBlock[0])
-        yi = len(mainBlock)
+        xi = mainWidth
+        yi = mainHeight
 
     # ... and if it's not goingLeft but it's goingDown:
     elif not goLeft and goDown:
         # slope going from NW => SE
         # start off at the top left
         x = 0
-        y = (0 if subBlock == None else len(subBlock))
-        xi = len(mainBlock[0])
-        yi = len(mainBlock)
+        y = subHeight
+        xi = mainWidth
+        yi = mainHeight
 
     # ... and finally, if it's goingLeft and goingDown:
     else:
         # slope going from SW => NE
         # start off at the bottom left
         x = 0
-        y = height - len(mainBlock)
-        xi = len(mainBlock[0])
-        yi = -len(mainBlock)
+        y = height - mainHeight
+        xi = mainWidth
+        yi = -mainHeight
 
 
     # finally draw it
     for i in xrange(drawAmount):
-        PutObjectArray(dest, x, y, mainBlock, width, height)
+        PutObjectArray(dest, x, y, mainRows, width, height)
         if subBlock != None:
             xb = x
-            if goLeft: xb = x + len(mainBlock[0]) - len(subBlock[0])
+            if goLeft: xb = x + mainWidth - subWidth
             if goDown:
-                PutObjectArray(dest, xb, y - len(subBlock), subBlock, width, height)
+                PutObjectArray(dest, xb, y - subHeight, subRows, width, height)
             else:
-                PutObjectArray(dest, xb, y + len(mainBlock), subBlock, width, height)
+                PutObjectArray(dest, xb, y + mainHeight, subRows, width, height)
         x += xi
         y += yi
 
 
 def PutObjectArray(dest, xo, yo, block, width, height):
     """Places a tile array into an object"""
-    #for y in xrange(yo,min(yo+len(block),height)):
-    for y in xrange(yo,yo+len(block)):
-        if y < 0: continue
-        if y >= height: continue
-        drow = dest[y]
+    for y in xrange(max(yo, 0), min(yo+len(block), height)):
         srow = block[y-yo]
-        #for x in xrange(xo,min(xo+len(srow),width)):
-        for x in xrange(xo,xo+len(srow)):
-            if x < 0: continue
-            if x >= width: continue
-            drow[x] = srow[x-xo][1]
+        xs = max(xo, 0)
+        xe = min(xo+len(srow), width)
+        if xs < xe:
+            dest[y][xs:xe] = srow[xs-xo:xe-xo]
 
 
 def GetSlopeSections(obj):
@@ -774,34 +1203,15 @@ def GetSlopeSections(obj):
 
 
 def CreateSection(rows):
-    """Create a slope section"""
-    # calculate width
+    """Create a slope section: its width and the tile numbers in each row"""
     width = 0
-    for row in rows:
-        thiswidth = CountTiles(row)
-        if width < thiswidth: width = thiswidth
-
-    # create the section
     section = []
     for row in rows:
-        drow = [0] * width
-        x = 0
-        for tile in row:
-            if (tile[0] & 0x80) == 0:
-                drow[x] = tile
-                x += 1
+        drow = array('H', [tile[1] for tile in row if (tile[0] & 0x80) == 0])
+        if width < len(drow): width = len(drow)
         section.append(drow)
 
-    return section
-
-
-def CountTiles(row):
-    """Counts the amount of real tiles in an object row"""
-    res = 0
-    for tile in row:
-        if (tile[0] & 0x80) == 0:
-            res += 1
-    return res
+    return width, section
 
 
 def CreateTilesets():
@@ -813,67 +1223,151 @@ def CreateTilesets():
     #TileBehaviours = [0]*1024
     ObjectDefinitions = [None]*4
     sprites.Tiles = Tiles
+    RenderedObjects.clear()
+
+    # anything still loading was meant for the old tilesets
+    if TilesetQueue is not None: TilesetQueue.Cancel()
 
 
 def LoadTileset(idx, name):
     try:
         return _LoadTileset(idx, name)
     except:
-        QtGui.QMessageBox.warning(None, 'Error',  'An error occurred while trying to load %s.arc. Check your Texture folder to make sure it is complete and not corrupted. The editor may run in a broken state or crash after this.' % name)
+        TilesetError(name)
         return False
 
 
+def TilesetError(name):
+    QtGui.QMessageBox.warning(None, 'Error',  'An error occurred while trying to load %s.arc. Check your Texture folder to make sure it is complete and not corrupted. The editor may run in a broken state or crash after this.' % name)
+
+
 def _LoadTileset(idx, name):
     """Load in a tileset into a specific slot"""
-    # read the archive
+    # a background load for this slot would overwrite it when it finishes
+    if TilesetQueue is not None: TilesetQueue.Cancel(idx)
+
+    found = FindTileset(name)
+    if found is None: return False
+    arcname, key, stamp = found
+
+    if BindCachedTileset(idx, name, key, stamp): return True
+    return FinishTileset(idx, name, key, stamp, DecodeTileset(name, arcname, TilesetCacheDir))
+
+
+def FindTileset(name):
+    """Returns the archive, memory cache key and stamp for a tileset, or None
+    if the archive is missing"""
     arcname = os.path.join(gamePath, 'Texture', name+'.arc')
 
     if not os.path.isfile(arcname):
         QtGui.QMessageBox.warning(None, 'Error',  'Cannot find the required tileset file %s.arc for this level. Check your Texture folder and make sure it contains the required file.' % name)
+        return None
+
+    st = os.stat(arcname)
+    return arcname, (os.path.abspath(arcname), EnableAlpha), (st.st_size, st.st_mtime)
+
+
+def BindCachedTileset(idx, name, key, stamp):
+    """Puts a tileset into a slot if it's still in memory"""
+    if TilesetMemory is None: return False
+    entry = TilesetMemory.get(key, stamp)
+    if entry is None: return False
+
+    tiles, defs = entry
+    BindTileset(idx, name, tiles, defs)
+    return True
+
+
+def DecodeTileset(name, arcname, cachedir):
+    """Reads a tileset archive into (QImage, defs), or None if the texture is
+    missing. cachedir is the folder for the disk cache, or None to skip it.
+    No widgets or pixmaps are touched, so this can run on a worker
+    thread."""
+    # use the decoded copy from the cache if the archive hasn't changed
+    cached = LoadCachedTileset(arcname, cachedir)
+    if cached is not None:
+        rgbdata, indexfile, deffile = cached
+        # copied, because the image would otherwise point into rgbdata
+        img = QtGui.QImage(rgbdata, 1024, 256, 4096, QtGui.QImage.Format_ARGB32_Premultiplied).copy()
+        return img, LoadObjectDefinitions(indexfile, deffile)
+
+    # map the archive and only pull out the entries we need
+    arc = archive.U8.loadFile(arcname, lazy=True)
+    try:
+        result = _LoadTilesetFromArchive(name, arc)
+    finally:
+        arc.close()
+
+    if result is None: return None
+    img, indexfile, deffile = result
+    SaveCachedTileset(arcname, img, indexfile, deffile, cachedir)
+    return img, LoadObjectDefinitions(indexfile, deffile)
+
+
+def FinishTileset(idx, name, key, stamp, result):
+    """Turns a decoded tileset into tiles and puts it into a slot"""
+    if result is None:
+        QtGui.QMessageBox.warning(None, 'Error',  'Cannot find the required texture within the tileset file %s.arc, so it will not be loaded. Keep in mind that the tileset file cannot be renamed without changing the names of the texture/object files within the archive as well!' % name)
         return False
 
-    arcf = open(arcname,'rb')
-    arcdata = arcf.read()
-    arcf.close()
+    img, defs = result
+    tiles = AtlasTiles(img)
+    if TilesetMemory is not None:
+        TilesetMemory.put(key, stamp, tiles, defs)
+    BindTileset(idx, name, tiles, defs)
+    return True
 
-    arc = archive.U8.load(arcdata)
 
+def _LoadTilesetFromArchive(name, arc):
+    """Decode the texture from an opened tileset archive, returning (QImage,
+    object index file, object definition file) or None"""
     # decompress the textures
     try:
         comptiledata = arc['BG_tex/%s_tex.bin.LZ' % name]
     except KeyError:
-        QtGui.QMessageBox.warning(None, 'Error',  'Cannot find the required texture within the tileset file %s.arc, so it will not be loaded. Keep in mind that the tileset file cannot be renamed without changing the names of the texture/object files within the archive as well!' % name)
-        return False
+        return None
 
     # load in the textures - uses a different method if nsmblib exists
-    if HaveNSMBLib:
+    if HaveNSMBLib and hasattr(nsmblib, 'decodeTilesetInto'):
+        # nsmblib 0.7+ decodes straight into the image's memory. It only lets
+        # other threads run while it works if both buffers support the new
+        # buffer protocol, which depends on the sip version for img.bits().
+        img = QtGui.QImage(1024, 256, QtGui.QImage.Format_ARGB32_Premultiplied)
+        bits = img.bits()
+        bits.setsize(img.byteCount())
+        tiledata = bytearray(nsmblib.decompressedSize11LZS(comptiledata) or 0)
+        if nsmblib.decompress11LZSInto(comptiledata, tiledata) is None:
+            decoded = False
+        elif EnableAlpha:
+            decoded = nsmblib.decodeTilesetInto(tiledata, bits)
+        else:
+            # opaque mode needs nsmblib 0.8, which is checked on startup
+            decoded = nsmblib.decodeTilesetInto(tiledata, bits, False)
+
+        # a blank texture would end up in the disk cache, so fail loudly
+        if not decoded:
+            raise ValueError('the texture in %s could not be decoded' % name)
+    elif HaveNSMBLib:
         tiledata = nsmblib.decompress11LZS(comptiledata)
         rgbdata = nsmblib.decodeTileset(tiledata)
-        img = QtGui.QImage(rgbdata, 1024, 256, 4096, QtGui.QImage.Format_ARGB32_Premultiplied)
+        # copied, because the image would otherwise point into rgbdata
+        img = QtGui.QImage(rgbdata, 1024, 256, 4096, QtGui.QImage.Format_ARGB32_Premultiplied).copy()
+    elif HaveNumPy:
+        img = LoadTextureUsingNumPy(lz77.decompress11LZS(comptiledata))
     else:
-        lz = lz77.LZS11()
-        img = LoadTextureUsingOldMethod(lz.Decompress11LZS(comptiledata))
+        img = LoadTextureUsingOldMethod(lz77.decompress11LZS(comptiledata))
 
-    # crop the tiles out
-    dest = QtGui.QPixmap.fromImage(img)
+    # tile behaviours aren't needed yet?
 
-    sourcex = 4
-    sourcey = 4
-    tileoffset = idx*256
-    for i in xrange(tileoffset,tileoffset+256):
-        Tiles[i] = dest.copy(sourcex,sourcey,24,24)
-        sourcex += 32
-        if sourcex >= 1024:
-            sourcex = 4
-            sourcey += 32
+    return img, arc['BG_unt/%s_hd.bin' % name], arc['BG_unt/%s.bin' % name]
 
-    # tile behaviours aren't needed yet?
 
-    # load the object definitions
+def LoadObjectDefinitions(indexfile, deffile):
+    """Load the object definitions from a tileset's index and definition
+    files"""
     defs = [None]*256
 
-    indexfile = arc['BG_unt/%s_hd.bin' % name]
-    deffile = arc['BG_unt/%s.bin' % name]
+    deffile = bytearray(deffile)
     objcount = len(indexfile) / 4
     indexstruct = struct.Struct('>HBB')
 
@@ -882,17 +1376,337 @@ def _LoadTileset(idx, name):
         obj = ObjectDef()
         obj.width = data[1]
         obj.height = data[2]
-        obj.load(deffile,data[0],tileoffset)
+        obj.load(deffile,data[0],0)
+        obj.compile()
         defs[i] = obj
 
+    return defs
+
+
+def AtlasTiles(img):
+    """Turns a decoded tileset texture into an atlas pixmap and returns the
+    256 tiles inside it"""
+    atlas = QtGui.QPixmap.fromImage(img)
+    positions = []
+
+    # each tile has a 4 pixel border around it
+    sourcex = 4
+    sourcey = 4
+    for i in xrange(256):
+        positions.append((sourcex, sourcey))
+        sourcex += 32
+        if sourcex >= 1024:
+            sourcex = 4
+            sourcey += 32
+
+    shrunk = ShrinkTiles(img, positions)
+    opacity = TileOpacity(img, positions)
+    return [Tile(atlas, x, y, shrunk[i], opacity[i]) for i, (x, y) in enumerate(positions)]
+
+
+def BindTileset(idx, name, tiles, defs):
+    """Put a decoded tileset into a specific slot"""
+    tileoffset = idx*256
+    Tiles[tileoffset:tileoffset+256] = tiles
     ObjectDefinitions[idx] = defs
 
+    # overrides can touch tiles outside this slot, so they're applied every
+    # time; changing the object definitions again is harmless
     ProcessOverrides(idx, name)
+    RenderedObjects.invalidate(idx)
+
+
+class TilesetCache():
+    """Keeps the tiles and object definitions of recently used tilesets in
+    memory, so switching areas or reopening a level just rebinds them"""
+
+    def __init__(self, budget):
+        """Constructor; budget is the memory to use in bytes"""
+        self.budget = budget
+        self.entries = RecentlyUsed()
+        self.used = 0
+
+    def get(self, key, stamp):
+        """Returns (tiles, defs) for a key if it's cached with the same stamp"""
+        entry = self.entries.get(key)
+        if entry is None: return None
+
+        if entry[0] != stamp:
+            # the file changed on disk
+            self.remove(key)
+            return None
+
+        self.entries.touch(key)
+        return entry[1], entry[2]
+
+    def put(self, key, stamp, tiles, defs):
+        """Adds a tileset, dropping the least recently used ones if needed"""
+        if key in self.entries: self.remove(key)
+
+        # all the tiles share one atlas for each level of detail
+        size = 0
+        for atlas, rect in tiles[0].sources:
+            size += atlas.width() * atlas.height() * 4
+        if size > self.budget: return
+
+        self.entries[key] = (stamp, tiles, defs, size)
+        self.used += size
+
+        while self.used > self.budget:
+            self.remove(self.entries.oldest())
+
+    def remove(self, key):
+        """Drops a tileset from the cache"""
+        entry = self.entries.pop(key)
+        self.used -= entry[3]
+
+    def clear(self):
+        """Drops everything"""
+        self.entries.clear()
+        self.used = 0
+
+
+class TilesetLoader(QtCore.QObject):
+    """Decodes tilesets on worker threads, so all four slots load at the same
+    time; each one is put into its slot on the GUI thread once it's ready"""
+
+    def __init__(self):
+        """Constructor"""
+        QtCore.QObject.__init__(self)
+        self.pending = {} # slot -> job number
+        self.jobs = 0
+        self.Decoded.connect(self.HandleDecoded, QtCore.Qt.QueuedConnection)
+
+    def Load(self, tilesets):
+        """Starts loading a list of (slot, name) pairs. Tilesets that are
+        still in memory are put into their slots straight away."""
+        for idx, name in tilesets:
+            self.Cancel(idx)
+
+            found = FindTileset(name)
+            if found is None: continue
+            arcname, key, stamp = found
+
+            if BindCachedTileset(idx, name, key, stamp): continue
+
+            self.jobs += 1
+            self.pending[idx] = self.jobs
+            job = TilesetLoader.Job(self, (self.jobs, idx, name, key, stamp), arcname, TilesetCacheDir)
+            QtCore.QThreadPool.globalInstance().start(job)
+
+    def Cancel(self, idx=None):
+        """Forgets about the load for a slot (or all of them) if there is one;
+        the worker still finishes, but its result is thrown away"""
+        if idx is None:
+            self.pending = {}
+        elif idx in self.pending:
+            del self.pending[idx]
+
+    def IsLoading(self, idx):
+        """Returns True if a slot is still being loaded"""
+        return idx in self.pending
+
+    def HandleDecoded(self, info):
+        """Puts a tileset that finished decoding into its slot"""
+        job, idx, name, key, stamp, result, failed = info
+        if self.pending.get(idx) != job: return
+        del self.pending[idx]
+
+        if failed:
+            TilesetError(name)
+            return
+
+        try:
+            loaded = FinishTileset(idx, name, key, stamp, result)
+        except:
+            TilesetError(name)
+            return
+
+        if loaded: self.TilesetLoaded.emit(idx)
+
+    Decoded = QtCore.pyqtSignal('PyQt_PyObject')
+    TilesetLoaded = QtCore.pyqtSignal(int)
+
+
+    class Job(QtCore.QRunnable):
+        """Decodes one tileset on a worker thread"""
+
+        def __init__(self, loader, info, arcname, cachedir):
+            """Constructor"""
+            QtCore.QRunnable.__init__(self)
+            self.loader = loader
+            self.info = info
+            self.arcname = arcname
+            self.cachedir = cachedir
+
+        def run(self):
+            """Decodes the tileset and hands it back to the GUI thread"""
+            result = None
+            failed = False
+            try:
+                result = DecodeTileset(self.info[2], self.arcname, self.cachedir)
+            except:
+                failed = True
+
+            self.loader.Decoded.emit(self.info + (result, failed))
+
+
+# Decoded tilesets are cached on disk, one file per archive and alpha mode:
+# a 64 byte header, the ARGB32 Premultiplied texture, the cache key, then
+# the archive's object index and definition files as they are. An entry is
+# used only if the archive's size and either its mtime or its CRC32 still
+# match the header.
+TilesetCacheVersion = 2
+TilesetCacheHeader = struct.Struct('<4sIIQdIIII')
+TilesetCacheDataSize = 1024*256*4
+
+TilesetCacheDir = None # set on startup, so workers never ask Qt for it
+
+def TilesetCachePath():
+    """Returns the folder decoded tilesets are cached in; this asks
+    QDesktopServices, so only call it on the GUI thread"""
+    path = None
+    if hasattr(QtGui.QDesktopServices, 'CacheLocation'):
+        path = unicode(QtGui.QDesktopServices.storageLocation(QtGui.QDesktopServices.CacheLocation))
+    if not path:
+        path = os.path.join(os.path.expanduser('~'), '.reggie')
+    return os.path.join(path, 'tilesets')
+
+
+def TilesetCacheKey(arcname):
+    """Identifies a tileset archive and the alpha mode it's decoded with"""
+    key = u'%s|%d' % (os.path.abspath(arcname), EnableAlpha)
+    return key.encode('utf-8')
+
+
+def TilesetCacheFile(arcname, cachedir):
+    """Returns the cache file used for a tileset archive"""
+    key = TilesetCacheKey(arcname)
+    return os.path.join(cachedir, '%08x.cache' % (zlib.crc32(key) & 0xFFFFFFFF))
+
+
+def FileCRC(filename):
+    f = open(filename, 'rb')
+    try:
+        return zlib.crc32(f.read()) & 0xFFFFFFFF
+    finally:
+        f.close()
+
+
+def LoadCachedTileset(arcname, cachedir):
+    """Returns the (ARGB32 data, object index file, object definition file)
+    cached for a tileset archive, or None if there's no usable entry"""
+    if cachedir is None: return None
+    try:
+        f = open(TilesetCacheFile(arcname, cachedir), 'rb')
+    except IOError:
+        return None
+
+    try:
+        header = f.read(64)
+        magic, version, alpha, size, mtime, crc, keysize, indexsize, defsize = TilesetCacheHeader.unpack_from(header, 0)
+        if magic != 'RTSC' or version != TilesetCacheVersion or alpha != int(EnableAlpha):
+            return None
+
+        st = os.stat(arcname)
+        if st.st_size != size:
+            return None
+        if st.st_mtime != mtime and FileCRC(arcname) != crc:
+            return None
+
+        rgbdata = f.read(TilesetCacheDataSize)
+        key = f.read(keysize)
+        indexfile = f.read(indexsize)
+        deffile = f.read(defsize)
+        if len(rgbdata) != TilesetCacheDataSize or len(indexfile) != indexsize or len(deffile) != defsize:
+            return None
+        if key != TilesetCacheKey(arcname):
+            return None
+
+        return rgbdata, indexfile, deffile
+    except Exception:
+        # a broken entry is just a cache miss
+        return None
+    finally:
+        f.close()
+
+
+def SaveCachedTileset(arcname, img, indexfile, deffile, cachedir):
+    """Writes a decoded tileset to the cache"""
+    if cachedir is None: return
+    try:
+        st = os.stat(arcname)
+        crc = FileCRC(arcname)
+
+        if img.format() != QtGui.QImage.Format_ARGB32_Premultiplied:
+            img = img.convertToFormat(QtGui.QImage.Format_ARGB32_Premultiplied)
+        rgbdata = img.bits().asstring(TilesetCacheDataSize)
+
+        key = TilesetCacheKey(arcname)
+        header = TilesetCacheHeader.pack('RTSC', TilesetCacheVersion, int(EnableAlpha), st.st_size, st.st_mtime, crc, len(key), len(indexfile), len(deffile))
+
+        if not os.path.isdir(cachedir): os.makedirs(cachedir)
+
+        # write it under another name first so a half-written file is never used
+        filename = TilesetCacheFile(arcname, cachedir)
+        f = open(filename + '.tmp', 'wb')
+        try:
+            f.write(header.ljust(64, '\0'))
+            f.write(rgbdata)
+            f.write(key)
+            f.write(indexfile)
+            f.write(deffile)
+        finally:
+            f.close()
+
+        if os.path.isfile(filename): os.remove(filename)
+        os.rename(filename + '.tmp', filename)
+    except Exception:
+        # the cache is only an optimisation, so failing to write it is fine
+        pass
+
+
+def DecodeTextureUsingNumPy(tiledata, alpha):
+    """Decodes a 1024x256 RGB4A3 texture into an array of ARGB32 Premultiplied
+    pixels, the same way nsmblib.decodeTileset does"""
+    d = numpy.frombuffer(tiledata, '>u2', 262144)
+
+    # the texture is made of 4x4 tiles, 256 across and 64 down
+    d = d.reshape(64, 256, 4, 4).transpose(0, 2, 1, 3).reshape(256, 1024).astype(numpy.uint32)
+
+    # RGB555 pixels have the top bit set
+    argb = 0xFF000000 | ((d & 0x7C00) << 9) | ((d & 0x3E0) << 6) | ((d & 0x1F) << 3)
+
+    # RGB4A3 pixels
+    r = (d & 0xF00) >> 4
+    g = d & 0xF0
+    b = (d & 0xF) << 4
+    if alpha:
+        # premultiply, like Qt's PREMUL()
+        al = (d & 0x7000) >> 7
+        r *= al; r = (r + (r >> 8) + 0x80) >> 8
+        g *= al; g = (g + (g >> 8) + 0x80) >> 8
+        b *= al; b = (b + (b >> 8) + 0x80) >> 8
+    else:
+        al = 0xFF
+
+    rgb4a3 = (al << 24) | (r << 16) | (g << 8) | b
+    # native order, like Format_ARGB32
+    return numpy.where(d & 0x8000, argb, rgb4a3).astype(numpy.uint32)
+
+
+def LoadTextureUsingNumPy(tiledata):
+    argb = DecodeTextureUsingNumPy(tiledata, EnableAlpha)
+    data = argb.tobytes()
+
+    # copied, because the image would otherwise point into data
+    return QtGui.QImage(data, 1024, 256, 4096, QtGui.QImage.Format_ARGB32_Premultiplied).copy()
 
 
 def LoadTextureUsingOldMethod(tiledata):
+    # tiledata can be a string or a list of byte values
     tx = 0; ty = 0
-    iter = tiledata.__iter__()
+    iter = bytearray(tiledata).__iter__()
     dest = QtGui.QImage(1024,256,QtGui.QImage.Format_ARGB32)
     dest.fill(QtCore.Qt.transparent)
 
@@ -931,10 +1745,13 @@ def LoadTextureUsingOldMethod(tiledata):
 
 def UnloadTileset(idx):
     """Unload the tileset from a specific slot"""
+    if TilesetQueue is not None: TilesetQueue.Cancel(idx)
+
     for i in xrange(idx*256, idx*256+256):
         Tiles[i] = None
 
     ObjectDefinitions[idx] = None
+    RenderedObjects.invalidate(idx)
 
 
 def ProcessOverrides(idx, name):
@@ -963,9 +1780,11 @@ def ProcessOverrides(idx, name):
             replace = offset + 9
             for i in xrange(38, 49):
                 defs[i].rows[0][0] = (0, replace, 0)
+                defs[i].compile()
                 replace += 1
             for i in xrange(26, 38):
                 defs[i].rows[0][0] = (0, replace, 0)
+                defs[i].compile()
                 replace += 1
 
             # now the extra stuff (invisible collisions etc)
@@ -1175,16 +1994,18 @@ def LoadOverrides():
     global Overrides
     Overrides = [None]*320
 
-    OverrideBitmap = QtGui.QPixmap('reggiedata/overrides.png')
+    OverrideImage = QtGui.QImage('reggiedata/overrides.png')
+    OverrideBitmap = QtGui.QPixmap.fromImage(OverrideImage)
     idx = 0
     xcount = OverrideBitmap.width() / 24
     ycount = OverrideBitmap.height() / 24
     sourcex = 0
     sourcey = 0
+    positions = []
 
     for y in xrange(ycount):
         for x in xrange(xcount):
-            Overrides[idx] = OverrideBitmap.copy(sourcex, sourcey, 24, 24)
+            positions.append((idx, sourcex, sourcey))
             idx += 1
             sourcex += 24
         sourcex = 0
@@ -1193,6 +2014,11 @@ def LoadOverrides():
             idx -= (idx % 64)
             idx += 64
 
+    shrunk = ShrinkTiles(OverrideImage, [(x, y) for idx, x, y in positions])
+    opacity = TileOpacity(OverrideImage, [(x, y) for idx, x, y in positions])
+    for i, (idx, x, y) in enumerate(positions):
+        Overrides[idx] = Tile(OverrideBitmap, x, y, shrunk[i], opacity[i])
+
 
 Level = None
 Dirty = False
@@ -1269,8 +2095,202 @@ def SetDirty(noautosave=False):
         pass
 
 
-def MapPositionToZoneID(zones, x, y):
-    """Returns the zone ID containing or nearest the specified position"""
+class SpatialIndex():
+    """A uniform grid of rects, so the items in an area can be found without
+    going through all of them. Rects are (x1, y1, x2, y2)."""
+
+    def __init__(self, cellsize):
+        """Constructor"""
+        self.cellsize = cellsize
+        self.cells = {} # (cx, cy) -> set of items
+        self.rects = {} # item -> rect
+
+    def __len__(self):
+        return len(self.rects)
+
+    def __contains__(self, item):
+        return item in self.rects
+
+    def cellsFor(self, x1, y1, x2, y2):
+        """Returns the cells a rect touches, including its far edges"""
+        size = self.cellsize
+        xs = xrange(int(x1 // size), int(max(x1, x2) // size) + 1)
+        ys = xrange(int(y1 // size), int(max(y1, y2) // size) + 1)
+        return [(cx, cy) for cx in xs for cy in ys]
+
+    def insert(self, item, rect):
+        """Adds an item, or moves it if it's already in the index"""
+        if item in self.rects: self.remove(item)
+        self.rects[item] = rect
+
+        cells = self.cells
+        for cell in self.cellsFor(*rect):
+            if cell in cells:
+                cells[cell].add(item)
+            else:
+                cells[cell] = set([item])
+
+    def remove(self, item):
+        """Removes an item if it's in the index"""
+        rect = self.rects.pop(item, None)
+        if rect == None: return
+
+        cells = self.cells
+        for cell in self.cellsFor(*rect):
+            contents = cells[cell]
+            contents.discard(item)
+            if len(contents) == 0: del cells[cell]
+
+    def candidates(self, x1, y1, x2, y2):
+        """Returns the items in the cells a rect touches"""
+        found = set()
+        cells = self.cells
+        for cell in self.cellsFor(x1, y1, x2, y2):
+            if cell in cells: found.update(cells[cell])
+        return found
+
+    def query(self, x1, y1, x2, y2):
+        """Returns the items whose rects overlap a rect"""
+        rects = self.rects
+        result = []
+        for item in self.candidates(x1, y1, x2, y2):
+            r = rects[item]
+            if r[0] < x2 and r[2] > x1 and r[1] < y2 and r[3] > y1:
+                result.append(item)
+        return result
+
+    def at(self, x, y):
+        """Returns the items whose rects contain a point, edges included"""
+        rects = self.rects
+        result = []
+        for item in self.candidates(x, y, x, y):
+            r = rects[item]
+            if r[0] <= x <= r[2] and r[1] <= y <= r[3]:
+                result.append(item)
+        return result
+
+    def nearest(self, x, y):
+        """Returns the items nearest to a point (more than one if they're
+        tied), looking at cells further out until nothing closer is left"""
+        if len(self.rects) == 0: return []
+
+        size = self.cellsize
+        cx = int(x // size)
+        cy = int(y // size)
+
+        rects = self.rects
+        cells = self.cells
+        best = None
+        found = []
+        seen = set()
+        ring = 0
+        while len(seen) < len(rects):
+            # anything in this ring is at least this far away
+            if best != None and best < (ring - 1) * size: break
+
+            for cell in self.ring(cx, cy, ring):
+                if cell in cells:
+                    for item in cells[cell]:
+                        if item in seen: continue
+                        seen.add(item)
+
+                        r = rects[item]
+                        xdist = max(r[0] - x, x - r[2], 0)
+                        ydist = max(r[1] - y, y - r[3], 0)
+                        dist = (xdist**2+ydist**2)**0.5
+                        if best == None or dist < best:
+                            best = dist
+                            found = [item]
+                        elif dist == best:
+                            found.append(item)
+            ring += 1
+
+        return found
+
+    def extent(self):
+        """Returns the largest right and bottom edges of the rects, or
+        (0, 0) if there aren't any"""
+        if len(self.cells) == 0: return (0, 0)
+
+        # the furthest edges are in the last column and row of cells
+        cells = self.cells
+        rects = self.rects
+        maxcx = max([cell[0] for cell in cells])
+        maxcy = max([cell[1] for cell in cells])
+        right = 0
+        bottom = 0
+        for cell, contents in cells.iteritems():
+            if cell[0] == maxcx:
+                right = max(right, max([rects[item][2] for item in contents]))
+            if cell[1] == maxcy:
+                bottom = max(bottom, max([rects[item][3] for item in contents]))
+        return (right, bottom)
+
+    def ring(self, cx, cy, ring):
+        """Returns the cells on the edge of the square ring cells out from a
+        cell"""
+        if ring == 0: return [(cx, cy)]
+
+        x1 = cx - ring; x2 = cx + ring
+        y1 = cy - ring; y2 = cy + ring
+        cells = []
+        for rx in xrange(x1, x2 + 1):
+            cells.append((rx, y1))
+            cells.append((rx, y2))
+        for ry in xrange(y1 + 1, y2):
+            cells.append((x1, ry))
+            cells.append((x2, ry))
+        return cells
+
+
+class LevelIndex():
+    """Where everything in the level is, so the items in an area can be found
+    without going through all of them. It's kept up to date as items move,
+    resize and are added to or removed from the scene."""
+
+    def __init__(self, items):
+        """Builds the index for the items that are in the scene"""
+        self.items = SpatialIndex(384) # item -> rect in the scene
+        self.zones = SpatialIndex(512) # zone -> rect in level units
+
+        for item in items:
+            if item.scene() != None: self.update(item)
+
+    def update(self, item):
+        """Adds an item, or moves it to where it is now"""
+        r = item.sceneBoundingRect()
+        self.items.insert(item, (r.left(), r.top(), r.right(), r.bottom()))
+
+        if isinstance(item, ZoneItem):
+            self.zones.insert(item, (item.objx, item.objy, item.objx + item.width, item.objy + item.height))
+
+    def remove(self, item):
+        """Removes an item that's left the scene"""
+        self.items.remove(item)
+        self.zones.remove(item)
+
+    def query(self, x1, y1, x2, y2):
+        """Returns the items overlapping a rect of the scene"""
+        return self.items.query(x1, y1, x2, y2)
+
+    def extent(self):
+        """Returns the right and bottom edges of everything, in the scene"""
+        return self.items.extent()
+
+
+def MapPositionToZoneID(zones, x, y, index=None):
+    """Returns the zone ID containing or nearest the specified position. Passing
+    the zones of a LevelIndex saves checking every zone."""
+    if index != None:
+        # the first zone in the list wins when there's more than one
+        inside = index.at(x, y)
+        if len(inside) > 0:
+            return min([zone.id for zone in inside])
+
+        nearest = index.nearest(x, y)
+        if len(nearest) == 0: return -1
+        return min([(zone.id, zone.zoneID) for zone in nearest])[1]
+
     id = 0
     minimumdist = -1
     rval = -1
@@ -1296,13 +2316,198 @@ def MapPositionToZoneID(zones, x, y):
     return rval
 
 
+def CountAreas(arc):
+    """Returns the number of areas in a level archive"""
+    count = 0
+    if arc.isdir('course'):
+        for fname in arc.listdir('course'):
+            if fname.startswith('course'):
+                area = int(fname[6])
+                if area > count: count = area
+    return count
+
+
+class LayerTilemap():
+    """The tile numbers for a whole layer, so the scene can paint any part of
+    it straight away. It's kept up to date as objects are added, changed and
+    removed; later objects in the layer go over earlier ones."""
+
+    def __init__(self, layer):
+        """Builds the tilemap for a list of objects"""
+        self.layer = layer
+        self.tiles = array('h', [-1]) * (1024*512)
+        self.index = SpatialIndex(16) # where each object is drawn
+        self.order = {} # object -> position in the layer
+        self.next = len(layer)
+
+        for i, obj in enumerate(layer):
+            self.order[obj] = i
+            self.index.insert(obj, (obj.objx, obj.objy, obj.objx + obj.width, obj.objy + obj.height))
+            self.stamp(obj, 0, 0, 1024, 512)
+
+    def update(self, obj, changed=None):
+        """Redraws an object after it's added, moved, resized or changed, and
+        returns the rects that were redrawn. If only some rects of tiles
+        changed (like the strips a resize touches), changed can list them."""
+        x1, y1, x2, y2 = rect = (obj.objx, obj.objy, obj.objx + obj.width, obj.objy + obj.height)
+        old = self.index.rects.get(obj)
+        self.index.insert(obj, rect)
+
+        # objects are only ever added to the end of a layer
+        if obj not in self.order:
+            self.order[obj] = self.next
+            self.next += 1
+
+        if old != None and changed != None:
+            for rect in changed: self.redraw(*rect)
+            return changed
+
+        if old != None:
+            x1 = min(x1, old[0]); y1 = min(y1, old[1])
+            x2 = max(x2, old[2]); y2 = max(y2, old[3])
+        self.redraw(x1, y1, x2, y2)
+        return [(x1, y1, x2, y2)]
+
+    def remove(self, obj):
+        """Clears an object that was removed from the layer"""
+        old = self.index.rects.get(obj)
+        if old == None: return None
+        self.index.remove(obj)
+        del self.order[obj]
+        self.redraw(*old)
+        return old
+
+    def redraw(self, x1, y1, x2, y2):
+        """Draws a rect of the tilemap again from the objects over it"""
+        x1 = max(x1, 0); y1 = max(y1, 0)
+        x2 = min(x2, 1024); y2 = min(y2, 512)
+        if x1 >= x2 or y1 >= y2: return
+
+        tiles = self.tiles
+        blank = array('h', [-1]) * (x2 - x1)
+        for y in xrange(y1, y2):
+            tiles[y*1024+x1:y*1024+x2] = blank
+
+        # later objects go over earlier ones
+        objs = self.index.query(x1, y1, x2, y2)
+        objs.sort(key=self.order.__getitem__)
+
+        stamp = self.stamp
+        for obj in objs:
+            stamp(obj, x1, y1, x2, y2)
+
+    def stamp(self, obj, x1, y1, x2, y2):
+        """Draws the part of an object inside a rect onto the tilemap"""
+        ox = obj.objx
+        oy = obj.objy
+        data = obj.objdata
+        sx1 = max(x1, ox); sx2 = min(x2, ox + obj.width)
+        sy1 = max(y1, oy); sy2 = min(y2, oy + obj.height, oy + len(data))
+        if sx1 >= sx2: return
+
+        tiles = self.tiles
+        for y in xrange(sy1, sy2):
+            row = data[y - oy][sx1 - ox:sx2 - ox]
+            if len(row) == 0: continue
+
+            # empty tiles let the ones underneath show through
+            dest = y*1024 + sx1
+            if min(row) > 0:
+                tiles[dest:dest+len(row)] = array('h', row)
+            else:
+                for tile in row:
+                    if tile > 0: tiles[dest] = tile
+                    dest += 1
+
+    def window(self, x1, y1, x2, y2):
+        """Returns the rows of tiles inside a rect"""
+        tiles = self.tiles
+        return [tiles[y*1024+x1:y*1024+x2] for y in xrange(y1, y2)]
+
+
+class TileChunkCache():
+    """The level's tiles pre-rendered in chunks of 16x16, with a pixmap for
+    each combination of visible layers and level of detail, so painting only
+    draws a few pixmaps. Edits throw away the chunks they touch, and the
+    least recently used chunks are dropped to stay within the memory
+    budget."""
+
+    def __init__(self, tilemaps, budget):
+        """Constructor; budget is the memory to use in bytes"""
+        self.tilemaps = tilemaps
+        self.budget = budget
+        self.entries = RecentlyUsed() # (cx, cy, show, lod) -> pixmap or None
+        self.used = 0
+
+    def get(self, cx, cy, show, lod=0):
+        """Returns the pixmap for a chunk, or None if it's empty"""
+        key = (cx, cy, show, lod)
+        entries = self.entries
+
+        if key in entries:
+            return entries.touch(key)
+
+        pm = self.render(cx, cy, show, lod)
+        if pm != None:
+            self.used += pm.width() * pm.height() * 4
+            while self.used > self.budget and len(entries) > 0:
+                self.drop(entries.oldest())
+
+        entries[key] = pm
+        return pm
+
+    def render(self, cx, cy, show, lod):
+        """Draws the visible layers of a chunk"""
+        x1 = cx * 16; y1 = cy * 16
+        windows = []
+        for layer in [2, 1, 0]:
+            if not show[layer]: continue
+            window = self.tilemaps[layer].window(x1, y1, x1 + 16, y1 + 16)
+            if max([max(row) for row in window]) >= 0: windows.append(window)
+
+        if len(windows) == 0: return None
+
+        # leave out tiles that wouldn't show up anyway
+        windows = [window for window in CullTiles(windows) if max([max(row) for row in window]) >= 0]
+        if len(windows) == 0: return None
+
+        size = TileSizes[lod] * 16
+        pm = QtGui.QPixmap(size, size)
+        pm.fill(QtCore.Qt.transparent)
+        p = QtGui.QPainter(pm)
+        for window in windows: DrawTiles(p, window, lod)
+        p.end()
+        return pm
+
+    def drop(self, key):
+        """Forgets a chunk"""
+        pm = self.entries.pop(key)
+        if pm != None:
+            self.used -= pm.width() * pm.height() * 4
+
+    def invalidate(self, x1, y1, x2, y2):
+        """Forgets the chunks that overlap a rect of tiles"""
+        entries = self.entries
+        for cx in xrange(max(x1, 0) // 16, (min(x2, 1024) - 1) // 16 + 1):
+            for cy in xrange(max(y1, 0) // 16, (min(y2, 512) - 1) // 16 + 1):
+                for show in TileChunkCache.Layers:
+                    for lod in xrange(len(TileSizes)):
+                        key = (cx, cy, show, lod)
+                        if key in entries: self.drop(key)
+
+    # every combination of visible layers
+    Layers = [(a, b, c) for a in (False, True) for b in (False, True) for c in (False, True)]
+
+
 class LevelUnit():
     """Class for a full NSMBWii level archive"""
     def newLevel(self):
         """Creates a completely new level"""
         self.arcname = None
+        self.arcstamp = None
         self.filename = 'untitled'
         self.hasName = False
+        self.itemindex = None
         arc = archive.U8()
         arc['course'] = None
         arc['course/course1.bin'] = ''
@@ -1351,11 +2556,14 @@ class LevelUnit():
         LoadTileset(1, 'Pa1_nohara')
 
         self.layers = [[], [], []]
+        self.tilemaps = None
+        self.chunks = None
 
 
     def loadLevel(self, name, fullpath, area, progress=None):
         """Loads a specific level and area"""
         startTime = time.clock()
+        self.itemindex = None
 
         # read the archive
         if fullpath:
@@ -1374,6 +2582,7 @@ class LevelUnit():
                 self.hasName = True
 
             arcdata = AutoSaveData
+            self.arcstamp = None
             SetDirty(noautosave=True)
         else:
             if not os.path.isfile(self.arcname):
@@ -1383,41 +2592,25 @@ class LevelUnit():
             self.filename = os.path.basename(self.arcname)
             self.hasName = True
 
+            # the whole file is read into memory instead of being mapped,
+            # because saving writes back over this same file
             arcf = open(self.arcname,'rb')
             arcdata = arcf.read()
             arcf.close()
+            self.arcstamp = self.GetArchiveStamp()
 
-        self.arc = archive.U8.load(arcdata)
+        # entries are only sliced out of arcdata once they're actually read
+        self.arc = archive.U8.load(arcdata, lazy=True)
 
-        # this is a hackish method but let's go through the U8 files
-        reqcourse = 'course%d.bin' % area
-        reql0 = 'course%d_bgdatL0.bin' % area
-        reql1 = 'course%d_bgdatL1.bin' % area
-        reql2 = 'course%d_bgdatL2.bin' % area
+        # grab the files for this area
+        arc = self.arc
+        course = arc.get('course/course%d.bin' % area)
+        l0 = arc.get('course/course%d_bgdatL0.bin' % area)
+        l1 = arc.get('course/course%d_bgdatL1.bin' % area)
+        l2 = arc.get('course/course%d_bgdatL2.bin' % area)
 
-        course = None
-        l0 = None
-        l1 = None
-        l2 = None
         self.areanum = area
-        self.areacount = 0
-
-        for item,val in self.arc.files:
-            if val != None:
-                # it's a file
-                fname = item[item.rfind('/')+1:]
-                if fname == reqcourse:
-                    course = val
-                elif fname == reql0:
-                    l0 = val
-                elif fname == reql1:
-                    l1 = val
-                elif fname == reql2:
-                    l2 = val
-
-                if fname.startswith('course'):
-                    maxarea = int(fname[6])
-                    if maxarea > self.areacount: self.areacount = maxarea
+        self.areacount = CountAreas(arc)
 
         # load in the course file and blocks
         self.blocks = [None]*14
@@ -1452,13 +2645,12 @@ class LevelUnit():
 
         CreateTilesets()
         if progress != None: progress.setValue(1)
-        if self.tileset0 != '': LoadTileset(0, self.tileset0)
-        if progress != None: progress.setValue(2)
-        if self.tileset1 != '': LoadTileset(1, self.tileset1)
-        if progress != None: progress.setValue(3)
-        if self.tileset2 != '': LoadTileset(2, self.tileset2)
+
+        # these are decoded in the background; the objects using each one
+        # show placeholders until it's done
+        tilesets = [self.tileset0, self.tileset1, self.tileset2, self.tileset3]
+        TilesetQueue.Load([(idx, name) for idx, name in enumerate(tilesets) if name != ''])
         if progress != None: progress.setValue(4)
-        if self.tileset3 != '': LoadTileset(3, self.tileset3)
 
         # load the object layers
         if progress != None:
@@ -1466,6 +2658,8 @@ class LevelUnit():
             progress.setValue(5)
 
         self.layers = [[],[],[]]
+        self.tilemaps = None
+        self.chunks = None
 
         if l0 != None:
             self.LoadLayer(0,l0)
@@ -1482,8 +2676,41 @@ class LevelUnit():
 
         return True
 
+    def GetArchiveStamp(self):
+        """Identifies the current state of the archive file on disk"""
+        try:
+            st = os.stat(self.arcname)
+        except (OSError, TypeError):
+            return None
+        return (self.arcname, st.st_size, st.st_mtime)
+
+    def WriteArchive(self):
+        """Writes the U8 archive out to arcname, only patching the changed
+        files if the file on disk is still the one that was loaded/saved"""
+        patched = False
+        if self.arcstamp is not None and self.arcstamp == self.GetArchiveStamp():
+            f = open(self.arcname, 'r+b')
+            try:
+                patched = self.arc.patch(f)
+            finally:
+                f.close()
+
+        if not patched:
+            f = open(self.arcname, 'wb')
+            try:
+                self.arc.write(f)
+            finally:
+                f.close()
+
+        self.arcstamp = self.GetArchiveStamp()
+
     def save(self):
-        """Save the level back to a file"""
+        """Save the level back to a string"""
+        self.SaveArchive()
+        return self.arc._dump()
+
+    def SaveArchive(self):
+        """Places the current area back into the U8 archive"""
         # prepare this because else the game shits itself and refuses to load some sprites
         self.SortSpritesByZone()
 
@@ -1536,12 +2763,6 @@ class LevelUnit():
         arc['course/course%d_bgdatL1.bin' % areanum] = self.SaveLayer(1)
         arc['course/course%d_bgdatL2.bin' % areanum] = self.SaveLayer(2)
 
-        # save the U8 archive
-        #arcf = open(self.arcname,'wb')
-        #arcf.write(arc._dump())
-        #arcf.close()
-        return arc._dump()
-
     def LoadMetadata(self):
         """Loads block 1, the tileset names"""
         data = struct.unpack_from('32s32s32s32s', self.blocks[0])
@@ -1560,113 +2781,60 @@ class LevelUnit():
 
     def LoadEntrances(self):
         """Loads block 7, the entrances"""
-        entdata = self.blocks[6]
-        entcount = len(entdata) / 20
-        entstruct = struct.Struct('>HHxxxxBBBBxBBBHxx')
-        offset = 0
         entrances = []
-        for i in xrange(entcount):
-            data = entstruct.unpack_from(entdata,offset)
-            entrances.append(EntranceEditorItem(data[0], data[1], data[2], data[3], data[4], data[5], data[6], data[7], data[8], data[9]))
-            offset += 20
+        for data in blockcodec.Entrance.decode(self.blocks[6]):
+            entrances.append(EntranceEditorItem(*data))
         self.entrances = entrances
 
     def LoadSprites(self):
         """Loads block 8, the sprites"""
-        spritedata = self.blocks[7]
-        sprcount = len(spritedata) / 16
-        sprstruct = struct.Struct('>HHH8sxx')
-        offset = 0
         sprites = []
 
-        unpack = sprstruct.unpack_from
         append = sprites.append
         obj = SpriteEditorItem
-        for i in xrange(sprcount):
-            data = unpack(spritedata,offset)
+        for data in blockcodec.Sprite.decode(self.blocks[7]):
             append(obj(data[0], data[1], data[2], data[3]))
-            offset += 16
         self.sprites = sprites
 
     def LoadZones(self):
         """Loads block 3, the bounding preferences"""
-        bdngdata = self.blocks[2]
-        count = len(bdngdata) / 24
-        bdngstruct = struct.Struct('>llllxBxBxxxx')
-        offset = 0
-        bounding = []
-        for i in xrange(count):
-            datab = bdngstruct.unpack_from(bdngdata,offset)
-            bounding.append([datab[0], datab[1], datab[2], datab[3], datab[4], datab[5]])
-            offset += 24
+        bounding = [list(datab) for datab in blockcodec.Bounding.decode(self.blocks[2])]
         self.bounding = bounding
 
         """Loads block 5, the top level background values"""
-        bgAdata = self.blocks[4]
-        bgAcount = len(bgAdata) / 24
-        bgAstruct = struct.Struct('>xBhhhhHHHxxxBxxxx')
-        offset = 0
-        bgA = []
-        for i in xrange(bgAcount):
-            data = bgAstruct.unpack_from(bgAdata,offset)
-            bgA.append([data[0], data[1], data[2], data[3], data[4], data[5], data[6], data[7], data[8]])
-            offset += 24
+        bgA = [list(data) for data in blockcodec.Background.decode(self.blocks[4])]
         self.bgA = bgA
 
         """Loads block 6, the bottom level background values"""
-        bgBdata = self.blocks[5]
-        bgBcount = len(bgBdata) / 24
-        bgBstruct = struct.Struct('>xBhhhhHHHxxxBxxxx')
-        offset = 0
-        bgB = []
-        for i in xrange(bgBcount):
-            datab = bgBstruct.unpack_from(bgBdata,offset)
-            bgB.append([datab[0], datab[1], datab[2], datab[3], datab[4], datab[5], datab[6], datab[7], datab[8]])
-            offset += 24
+        bgB = [list(datab) for datab in blockcodec.Background.decode(self.blocks[5])]
         self.bgB = bgB
 
         """Loads block 10, the zone data"""
-        zonedata = self.blocks[9]
-        zonestruct = struct.Struct('>HHHHHHBBBBxBBBBxBB')
-        count = len(zonedata) / 24
-        offset = 0
         zones = []
-        for i in xrange(count):
-            dataz = zonestruct.unpack_from(zonedata,offset)
-            zones.append(ZoneItem(dataz[0], dataz[1], dataz[2], dataz[3], dataz[4], dataz[5], dataz[6], dataz[7], dataz[8], dataz[9], dataz[10], dataz[11], dataz[12], dataz[13], dataz[14], dataz[15], bounding, bgA, bgB, i))
-            offset += 24
+        i = 0
+        for dataz in blockcodec.Zone.decode(self.blocks[9]):
+            zones.append(ZoneItem(*(dataz + (bounding, bgA, bgB, i))))
+            i += 1
         self.zones = zones
 
     def LoadLocations(self):
         """Loads block 11, the sprite locations"""
-        locdata = self.blocks[10]
-        locstruct = struct.Struct('>HHHHBxxx')
-        count = len(locdata) / 12
-        offset = 0
         locations = []
-        for i in xrange(count):
-            data = locstruct.unpack_from(locdata, offset)
-            locations.append(SpriteLocationItem(data[0], data[1], data[2], data[3], data[4]))
-            offset += 12
+        for data in blockcodec.Location.decode(self.blocks[10]):
+            locations.append(SpriteLocationItem(*data))
         self.locations = locations
 
 
     def LoadLayer(self, idx, layerdata):
         """Loads a specific object layer from a string"""
-        objcount = len(layerdata) / 10
-        objstruct = struct.Struct('>HHHHH')
-        offset = 0
         z = (2 - idx) * 8192
 
         layer = self.layers[idx]
         append = layer.append
         obj = LevelObjectEditorItem
-        unpack = objstruct.unpack_from
-        for i in xrange(objcount):
-            data = unpack(layerdata,offset)
+        for data in blockcodec.Object.decode(layerdata):
             append(obj(data[0] >> 12, data[0] & 4095, idx, data[1], data[2], data[3], data[4], z))
             z += 1
-            offset += 10
 
     def LoadPaths(self):
         # Path struct: >BxHHH
@@ -1677,15 +2845,9 @@ class LevelUnit():
 
         # TODO: Render path, and everything above that
         """Loads paths"""
-        pathdata = self.blocks[12]
-        pathcount = len(pathdata) / 8
-        pathstruct = struct.Struct('>BxHHH')
-        offset = 0
-        unpack = pathstruct.unpack_from
         pathinfo = []
         paths = []
-        for i in xrange(pathcount):
-            data = unpack(pathdata, offset)
+        for data in blockcodec.Path.decode(self.blocks[12]):
             nodes = self.LoadPathNodes(data[1], data[2])
             add2p = {'id': int(data[0]),
                      'nodes': [],
@@ -1695,10 +2857,7 @@ class LevelUnit():
                 add2p['nodes'].append(node)
             pathinfo.append(add2p)
 
-
-            offset += 8
-
-        for i in xrange(pathcount):
+        for i in xrange(len(pathinfo)):
             xpi = pathinfo[i]
             for j in xrange(len(xpi['nodes'])):
                 xpj = xpi['nodes'][j]
@@ -1713,12 +2872,7 @@ class LevelUnit():
 
     def LoadPathNodes(self, startindex, count):
         ret = []
-        nodedata = self.blocks[13]
-        nodestruct = struct.Struct('>HHffhxx')
-        offset = startindex*16
-        unpack = nodestruct.unpack_from
-        for i in xrange(count):
-            data = unpack(nodedata, offset)
+        for data in blockcodec.PathNode.decode(self.blocks[13], count, startindex*16):
             ret.append({'x':int(data[0]),
                         'y':int(data[1]),
                         'speed':float(data[2]),
@@ -1726,7 +2880,6 @@ class LevelUnit():
                         'delay':int(data[4])
                         #'id':i
             })
-            offset += 16
         return ret
 
 
@@ -1743,77 +2896,51 @@ class LevelUnit():
 
     def SaveLayer(self, idx):
         """Saves an object layer to a string"""
-        layer = self.layers[idx]
-        offset = 0
-        objstruct = struct.Struct('>HHHHH')
-        buffer = create_string_buffer((len(layer) * 10) + 2)
         f_int = int
-        for obj in layer:
-            objstruct.pack_into(buffer, offset, f_int((obj.tileset << 12) | obj.type), f_int(obj.objx), f_int(obj.objy), f_int(obj.width), f_int(obj.height))
-            offset += 10
-        buffer[offset] = '\xff'
-        buffer[offset+1] = '\xff'
-        return buffer.raw
+        rows = [(f_int((obj.tileset << 12) | obj.type), f_int(obj.objx), f_int(obj.objy), f_int(obj.width), f_int(obj.height)) for obj in self.layers[idx]]
+        return blockcodec.Object.encode(rows, '\xff\xff')
 
     def SaveEntrances(self):
         """Saves the entrances back to block 7"""
-        offset = 0
-        entstruct = struct.Struct('>HHxxxxBBBBxBBBHxx')
-        buffer = create_string_buffer(len(self.entrances) * 20)
+        rows = []
         zonelist = self.zones
+        zoneindex = self.GetItemIndex().zones
         for entrance in self.entrances:
-            zoneID = MapPositionToZoneID(zonelist, entrance.objx, entrance.objy)
-            entstruct.pack_into(buffer, offset, int(entrance.objx), int(entrance.objy), int(entrance.entid), int(entrance.destarea), int(entrance.destentrance), int(entrance.enttype), zoneID, int(entrance.entlayer), int(entrance.entpath), int(entrance.entsettings))
-            offset += 20
-        self.blocks[6] = buffer.raw
+            zoneID = MapPositionToZoneID(zonelist, entrance.objx, entrance.objy, zoneindex)
+            rows.append((int(entrance.objx), int(entrance.objy), int(entrance.entid), int(entrance.destarea), int(entrance.destentrance), int(entrance.enttype), zoneID, int(entrance.entlayer), int(entrance.entpath), int(entrance.entsettings)))
+        self.blocks[6] = blockcodec.Entrance.encode(rows)
 
     def SavePaths(self):
         """Saves the paths back to block 13"""
-        pathstruct = struct.Struct('>BxHHH')
-        nodecount = 0
-        for path in self.pathdata:
-            nodecount += len(path['nodes'])
-        nodebuffer = create_string_buffer(nodecount * 16)
-        nodeoffset = 0
+        rows = []
+        noderows = []
         nodeindex = 0
-        offset = 0
-        buffer = create_string_buffer(len(self.pathdata) * 8)
         #[20:28:38]  [@Treeki] struct Path { unsigned char id; char padding; unsigned short startNodeIndex; unsigned short nodeCount; unsigned short unknown; };
         for path in self.pathdata:
             if(len(path['nodes']) < 1): continue
-            nodebuffer = self.SavePathNodes(nodebuffer, nodeoffset, path['nodes'])
+            self.SavePathNodes(noderows, path['nodes'])
 
-            pathstruct.pack_into(buffer, offset, int(path['id']), int(nodeindex), int(len(path['nodes'])), 2 if path['loops'] else 0)
-            offset += 8
-            nodeoffset += len(path['nodes']) * 16
+            rows.append((int(path['id']), int(nodeindex), int(len(path['nodes'])), 2 if path['loops'] else 0))
             nodeindex += len(path['nodes'])
-        self.blocks[12] = buffer.raw
-        self.blocks[13] = nodebuffer.raw
 
-    def SavePathNodes(self, buffer, offst, nodes):
-        """Saves the pathnodes back to block 14"""
-        offset = int(offst)
+        # empty paths are skipped, but the block still has a zeroed record
+        # for each one at the end
+        padding = '\0' * (blockcodec.Path.size * (len(self.pathdata) - len(rows)))
+        self.blocks[12] = blockcodec.Path.encode(rows, padding)
+        self.blocks[13] = blockcodec.PathNode.encode(noderows)
+
+    def SavePathNodes(self, rows, nodes):
+        """Adds the pathnodes to the rows for block 14"""
         #[20:29:04]  [@Treeki] struct PathNode { unsigned short x; unsigned short y; float speed; float unknownMaybeAccel; short unknown; char padding[2]; }
-        nodestruct = struct.Struct('>HHffhxx')
         for node in nodes:
-            nodestruct.pack_into(buffer, offset, int(node['x']), int(node['y']), float(node['speed']), float(node['accel']), int(node['delay']))
-            offset += 16
-        return buffer
+            rows.append((int(node['x']), int(node['y']), float(node['speed']), float(node['accel']), int(node['delay'])))
+        return rows
 
     def SaveSprites(self):
         """Saves the sprites back to block 8"""
-        offset = 0
-        sprstruct = struct.Struct('>HHH6sB1sxx')
-        buffer = create_string_buffer((len(self.sprites) * 16) + 4)
         f_int = int
-        for sprite in self.sprites:
-            sprstruct.pack_into(buffer, offset, f_int(sprite.type), f_int(sprite.objx), f_int(sprite.objy), sprite.spritedata[:6], sprite.zoneID, sprite.spritedata[7])
-            offset += 16
-        buffer[offset] = '\xff'
-        buffer[offset+1] = '\xff'
-        buffer[offset+2] = '\xff'
-        buffer[offset+3] = '\xff'
-        self.blocks[7] = buffer.raw
+        rows = [(f_int(sprite.type), f_int(sprite.objx), f_int(sprite.objy), sprite.spritedata[:6], sprite.zoneID, sprite.spritedata[7]) for sprite in self.sprites]
+        self.blocks[7] = blockcodec.SpriteOut.encode(rows, '\xff\xff\xff\xff')
 
     def SaveLoadedSprites(self):
         """Saves the list of loaded sprites back to block 9"""
@@ -1822,54 +2949,33 @@ class LevelUnit():
             if sprite.type not in ls: ls.append(sprite.type)
         ls.sort()
 
-        offset = 0
-        sprstruct = struct.Struct('>Hxx')
-        buffer = create_string_buffer(len(ls) * 4)
-        for s in ls:
-            sprstruct.pack_into(buffer, offset, int(s))
-            offset += 4
-        self.blocks[8] = buffer.raw
+        self.blocks[8] = blockcodec.LoadedSprite.encode([(int(s),) for s in ls])
 
 
     def SaveZones(self):
         """Saves blocks 10, 3, 5 and 6, the zone data, boundings, bgA and bgB data respectively"""
-        bdngstruct = struct.Struct('>llllxBxBxxxx')
-        bgAstruct = struct.Struct('>xBhhhhHHHxxxBxxxx')
-        bgBstruct = struct.Struct('>xBhhhhHHHxxxBxxxx')
-        zonestruct = struct.Struct('>HHHHHHBBBBxBBBBxBB')
-        offset = 0
         i = 0
-        zcount = len(Level.zones)
-        buffer2 = create_string_buffer(24*zcount)
-        buffer4 = create_string_buffer(24*zcount)
-        buffer5 = create_string_buffer(24*zcount)
-        buffer9 = create_string_buffer(24*zcount)
+        bdng = []
+        bgA = []
+        bgB = []
+        zones = []
         for z in Level.zones:
-            bdngstruct.pack_into(buffer2, offset, z.yupperbound, z.ylowerbound, z.unkbound1, z.unkbound2, i, 0xF)
-            bgAstruct.pack_into(buffer4, offset, i, z.XscrollA, z.YscrollA, z.YpositionA, z.XpositionA, z.bg1A, z.bg2A, z.bg3A, z.ZoomA)
-            bgBstruct.pack_into(buffer5, offset, i, z.XscrollB, z.YscrollB, z.YpositionB, z.XpositionB, z.bg1B, z.bg2B, z.bg3B, z.ZoomB)
-            zonestruct.pack_into(buffer9, offset, z.objx, z.objy, z.width, z.height, z.modeldark, z.terraindark, i, i, z.cammode, z.camzoom, z.visibility, i, i, z.unknownz, z.music, z.sfxmod)
-            offset += 24
+            bdng.append((z.yupperbound, z.ylowerbound, z.unkbound1, z.unkbound2, i, 0xF))
+            bgA.append((i, z.XscrollA, z.YscrollA, z.YpositionA, z.XpositionA, z.bg1A, z.bg2A, z.bg3A, z.ZoomA))
+            bgB.append((i, z.XscrollB, z.YscrollB, z.YpositionB, z.XpositionB, z.bg1B, z.bg2B, z.bg3B, z.ZoomB))
+            zones.append((z.objx, z.objy, z.width, z.height, z.modeldark, z.terraindark, i, i, z.cammode, z.camzoom, z.visibility, i, i, z.unknownz, z.music, z.sfxmod))
             i += 1
 
-        self.blocks[2] = buffer2.raw
-        self.blocks[4] = buffer4.raw
-        self.blocks[5] = buffer5.raw
-        self.blocks[9] = buffer9.raw
+        self.blocks[2] = blockcodec.Bounding.encode(bdng)
+        self.blocks[4] = blockcodec.Background.encode(bgA)
+        self.blocks[5] = blockcodec.Background.encode(bgB)
+        self.blocks[9] = blockcodec.Zone.encode(zones)
 
 
     def SaveLocations(self):
         """Saves block 11, the location data"""
-        locstruct = struct.Struct('>HHHHBxxx')
-        offset = 0
-        zcount = len(Level.locations)
-        buffer = create_string_buffer(12*zcount)
-
-        for z in Level.locations:
-            locstruct.pack_into(buffer, offset, int(z.objx), int(z.objy), int(z.width), int(z.height), int(z.id))
-            offset += 12
-
-        self.blocks[10] = buffer.raw
+        rows = [(int(z.objx), int(z.objy), int(z.width), int(z.height), int(z.id)) for z in Level.locations]
+        self.blocks[10] = blockcodec.Location.encode(rows)
 
 
     def RemoveFromLayer(self, obj):
@@ -1881,6 +2987,84 @@ class LevelUnit():
             upd = layer[i]
             upd.setZValue(upd.zValue() - 1)
 
+        if self.tilemaps != None:
+            rect = self.tilemaps[obj.layer].remove(obj)
+            if rect != None: self.chunks.invalidate(*rect)
+
+    def GetTilemaps(self):
+        """Returns the tilemap for each layer, building them if needed"""
+        if self.tilemaps == None:
+            self.tilemaps = [LayerTilemap(layer) for layer in self.layers]
+            self.chunks = TileChunkCache(self.tilemaps, TileChunkMemory)
+        return self.tilemaps
+
+    def GetChunks(self):
+        """Returns the pre-rendered tile chunks"""
+        self.GetTilemaps()
+        return self.chunks
+
+    def UpdateTilemap(self, obj, changed=None):
+        """Updates an object in its layer's tilemap after it's been added to
+        the layer or changed. changed can list the only rects of tiles that
+        need redrawing, for a resize."""
+        if self.tilemaps != None:
+            for rect in self.tilemaps[obj.layer].update(obj, changed):
+                self.chunks.invalidate(*rect)
+
+    def RefreshTilemaps(self, objs):
+        """Redraws objects whose tiles changed but which didn't move, like
+        after their tileset loads. Each chunk they cover is redrawn once, so
+        overlapping objects don't cost more."""
+        if self.tilemaps == None: return
+
+        chunks = [set(), set(), set()]
+        for obj in objs:
+            x1 = max(obj.objx, 0); y1 = max(obj.objy, 0)
+            x2 = min(obj.objx + obj.width, 1024); y2 = min(obj.objy + obj.height, 512)
+            if x1 >= x2 or y1 >= y2: continue
+
+            touched = chunks[obj.layer]
+            for cx in xrange(x1 // 16, (x2 - 1) // 16 + 1):
+                for cy in xrange(y1 // 16, (y2 - 1) // 16 + 1):
+                    touched.add((cx, cy))
+
+        for layer, touched in enumerate(chunks):
+            tilemap = self.tilemaps[layer]
+            for cx, cy in touched:
+                rect = (cx * 16, cy * 16, cx * 16 + 16, cy * 16 + 16)
+                tilemap.redraw(*rect)
+                self.chunks.invalidate(*rect)
+
+    def InvalidateTilemaps(self):
+        """Throws the tilemaps away after a lot of objects have changed; they're
+        built again the next time they're needed"""
+        self.tilemaps = None
+        self.chunks = None
+
+    def GetItemIndex(self):
+        """Returns the index of where everything is, building it if needed"""
+        if self.itemindex == None:
+            items = []
+            for layer in self.layers: items.extend(layer)
+            items.extend(self.sprites)
+            items.extend(self.entrances)
+            items.extend(self.locations)
+            items.extend(self.zones)
+            items.extend(self.paths)
+            self.itemindex = LevelIndex(items)
+        return self.itemindex
+
+    def UpdateItemIndex(self, item):
+        """Updates an item in the index after it's moved or resized, or been
+        added to or removed from the scene"""
+        index = self.itemindex
+        if index == None: return
+
+        if item.scene() != None:
+            index.update(item)
+        else:
+            index.remove(item)
+
     def SortSpritesByZone(self):
         """Sorts the sprite list by zone ID so it will work in-game"""
 
@@ -1889,9 +3073,10 @@ class LevelUnit():
 
         f_MapPositionToZoneID = MapPositionToZoneID
         zonelist = self.zones
+        zoneindex = self.GetItemIndex().zones
 
         for sprite in self.sprites:
-            zone = f_MapPositionToZoneID(zonelist, sprite.objx, sprite.objy)
+            zone = f_MapPositionToZoneID(zonelist, sprite.objx, sprite.objy, zoneindex)
             sprite.zoneID = zone
             if not split.has_key(zone):
                 split[zone] = []
@@ -1993,8 +3178,15 @@ class LevelEditorItem(QtGui.QGraphicsItem):
 
             return newpos
 
+        if change == QtGui.QGraphicsItem.ItemPositionHasChanged or change == QtGui.QGraphicsItem.ItemSceneHasChanged:
+            self.UpdateIndex()
+
         return QtGui.QGraphicsItem.itemChange(self, change, value)
 
+    def UpdateIndex(self):
+        """Updates the item in the level's index of where everything is"""
+        if Level != None: Level.UpdateItemIndex(self)
+
     def boundingRect(self):
         """Required for Qt"""
         return self.BoundingRect
@@ -2048,12 +3240,39 @@ class LevelObjectEditorItem(LevelEditorItem):
         self.tileset = tileset
         self.type = type
         self.updateObjCache()
+        Level.UpdateTilemap(self)
         self.update()
 
 
     def updateObjCache(self):
         """Updates the rendered object data"""
-        self.objdata = RenderObject(self.tileset, self.type, self.width, self.height)
+        self.objdata = RenderedObjects.get(self.tileset, self.type, self.width, self.height)
+
+
+    def resizeObjCache(self, oldwidth, oldheight):
+        """Updates the rendered object data after a resize that kept the top
+        left corner in place, reusing the old data. Returns the rects of
+        tiles that changed, as (x1, y1, x2, y2)."""
+        self.objdata = RenderedObjects.resize(self.tileset, self.type, self.objdata, self.width, self.height)
+
+        x = self.objx
+        y = self.objy
+        x2 = x + max(oldwidth, self.width)
+        y2 = y + max(oldheight, self.height)
+
+        obj = GetObjectDef(self.tileset, self.type)
+        if obj == None or obj.empty or obj.diagonal:
+            return [(x, y, x2, y2)]
+
+        # only the columns and rows from the repeating part onwards change
+        rects = []
+        if oldwidth != self.width:
+            same = ResizedPrefix(oldwidth, self.width, obj.fixedWidth, obj.tailWidth)
+            rects.append((x + same, y, x2, y2))
+        if oldheight != self.height:
+            same = ResizedPrefix(oldheight, self.height, obj.fixedHeight, obj.tailHeight)
+            rects.append((x, y + same, x2, y2))
+        return rects
 
 
     def UpdateRects(self):
@@ -2063,6 +3282,7 @@ class LevelObjectEditorItem(LevelEditorItem):
         self.SelectionRect = QtCore.QRectF(0,0,24*self.width-1,24*self.height-1)
         self.GrabberRect = QtCore.QRectF(24*self.width-5,24*self.height-5,5,5)
         self.LevelRect = QtCore.QRectF(self.objx,self.objy,self.width,self.height)
+        self.UpdateIndex()
 
 
     def itemChange(self, change, value):
@@ -2098,6 +3318,7 @@ class LevelObjectEditorItem(LevelEditorItem):
                 if self.positionChanged != None:
                     self.positionChanged(self, oldx, oldy, x, y)
 
+                Level.UpdateTilemap(self)
                 SetDirty()
 
                 #updRect = QtCore.QRectF(self.x(), self.y(), self.BoundingRect.width(), self.BoundingRect.height())
@@ -2108,11 +3329,15 @@ class LevelObjectEditorItem(LevelEditorItem):
 
             return newpos
 
-        return QtGui.QGraphicsItem.itemChange(self, change, value)
+        return LevelEditorItem.itemChange(self, change, value)
 
 
     def paint(self, painter, option, widget):
         """Paints the object"""
+        if TilesetQueue.IsLoading(self.tileset):
+            # the tiles aren't here yet
+            painter.fillRect(self.BoundingRect, QtGui.QBrush(QtGui.QColor.fromRgb(255,255,255,96), QtCore.Qt.Dense6Pattern))
+
         if self.isSelected():
             painter.setPen(QtGui.QPen(QtCore.Qt.white, 1, QtCore.Qt.DotLine))
             painter.drawRect(self.SelectionRect)
@@ -2135,6 +3360,7 @@ class LevelObjectEditorItem(LevelEditorItem):
                 self.setZValue(newZ) # swap the Z values so it doesn't look like the cloned item is the old one
                 newitem = LevelObjectEditorItem(self.tileset, self.type, self.layer, self.objx, self.objy, self.width, self.height, currentZ)
                 layer.append(newitem)
+                Level.UpdateTilemap(newitem)
                 mainWindow.scene.addItem(newitem)
                 mainWindow.scene.clearSelection()
                 self.setSelected(True)
@@ -2161,9 +3387,6 @@ class LevelObjectEditorItem(LevelEditorItem):
             clickedx = int((event.pos().x() - 10) / 24)
             clickedy = int((event.pos().y() - 10) / 24)
 
-            cx = self.objx
-            cy = self.objy
-
             if clickedx < 0: clickedx = 0
             if clickedy < 0: clickedy = 0
 
@@ -2173,18 +3396,17 @@ class LevelObjectEditorItem(LevelEditorItem):
                 self.dragstartx = clickedx
                 self.dragstarty = clickedy
 
+                oldwidth = self.width
+                oldheight = self.height
                 self.width += clickedx - dsx
                 self.height += clickedy - dsy
 
-                self.updateObjCache()
-
-                oldrect = self.BoundingRect
-                oldrect.translate(cx * 24, cy * 24)
-                newrect = QtCore.QRectF(self.x(), self.y(), self.width * 24, self.height * 24)
-                updaterect = oldrect.unite(newrect)
+                changed = self.resizeObjCache(oldwidth, oldheight)
+                Level.UpdateTilemap(self, changed)
 
                 self.UpdateRects()
-                self.scene().update(updaterect)
+                for rect in changed:
+                    self.scene().update(TileRectToScene(rect))
                 SetDirty()
 
             event.accept()
@@ -2296,6 +3518,7 @@ class ZoneItem(LevelEditorItem):
         self.GrabberRectTR = QtCore.QRectF(int(self.width*1.5)-5,0,5,5)
         self.GrabberRectBL = QtCore.QRectF(0,int(self.height*1.5)-5,5,5)
         self.GrabberRectBR = QtCore.QRectF(int(self.width*1.5)-5,int(self.height*1.5)-5,5,5)
+        self.UpdateIndex()
 
 
     def paint(self, painter, option, widget):
@@ -2445,7 +3668,9 @@ class ZoneItem(LevelEditorItem):
 
     def itemChange(self, change, value):
         """Avoids snapping for zones"""
-        return QtGui.QGraphicsItem.itemChange(self, change, value)
+        if change == QtGui.QGraphicsItem.ItemPositionChange:
+            return QtGui.QGraphicsItem.itemChange(self, change, value)
+        return LevelEditorItem.itemChange(self, change, value)
 
 class SpriteLocationItem(LevelEditorItem):
     """Level editor item that represents a sprite location"""
@@ -2490,6 +3715,7 @@ class SpriteLocationItem(LevelEditorItem):
         self.ZoneRect = QtCore.QRectF(self.objx,self.objy,self.width,self.height)
         self.DrawRect = QtCore.QRectF(1,1,self.width*1.5-2,self.height*1.5-2)
         self.GrabberRect = QtCore.QRectF(1.5*self.width-6,1.5*self.height-6,5,5)
+        self.UpdateIndex()
 
 
     def paint(self, painter, option, widget):
@@ -2684,6 +3910,7 @@ class SpriteEditorItem(LevelEditorItem):
         self.SelectionRect = QtCore.QRectF(0,0,int(xs*1.5-1),int(ys*1.5-1))
         self.RoundedRect = QtCore.QRectF(1,1,xs*1.5-2,ys*1.5-2)
         self.LevelRect = (QtCore.QRectF((self.objx + self.xoffset) / 16, (self.objy + self.yoffset) / 16, self.xsize/16, self.ysize/16))
+        self.UpdateIndex()
 
     def itemChange(self, change, value):
         """Makes sure positions don't go out of bounds and updates them as necessary"""
@@ -2750,7 +3977,7 @@ class SpriteEditorItem(LevelEditorItem):
 
             return newpos
 
-        return QtGui.QGraphicsItem.itemChange(self, change, value)
+        return LevelEditorItem.itemChange(self, change, value)
 
     def mousePressEvent(self, event):
         """Overrides mouse pressing events if needed for cloning"""
@@ -3067,6 +4294,10 @@ class PathEditorLineItem(LevelEditorItem):
         """Returns an empty string"""
         return ''
 
+    def UpdateIndex(self):
+        """The lines aren't in the level's index; only the nodes are"""
+        pass
+
     def nodePosChanged(self):
         self.computeBoundRectAndPos()
         self.scene().update()
@@ -3184,6 +4415,13 @@ class LevelOverviewWidget(QtGui.QWidget):
             # the level is created, but before it's loaded
             return
 
+        # the edges of the level come from the index instead of going
+        # through everything
+        index = Level.GetItemIndex()
+        right, bottom = index.extent()
+        self.maxX = right / 24
+        self.maxY = bottom / 24
+
         painter = QtGui.QPainter(self)
         painter.setRenderHint(QtGui.QPainter.Antialiasing, True)
 
@@ -3191,78 +4429,66 @@ class LevelOverviewWidget(QtGui.QWidget):
         painter.scale(self.scale, self.scale)
         painter.fillRect(0, 0, 1024, 512, self.bgbrush)
 
-        maxX = self.maxX
-        maxY = self.maxY
         dr = painter.drawRect
         fr = painter.fillRect
 
-        maxX = 0
-        maxY = 0
+        # only draw what's inside the area being painted
+        area = event.rect()
+        mult = self.posmult
+        found = index.query(area.left() * mult, area.top() * mult, (area.right() + 1) * mult, (area.bottom() + 1) * mult)
+
+        zones = []
+        objs = []
+        sprites = []
+        entrances = []
+        locations = []
+        for item in found:
+            if isinstance(item, ZoneItem): zones.append(item)
+            elif isinstance(item, LevelObjectEditorItem): objs.append(item)
+            elif isinstance(item, SpriteEditorItem): sprites.append(item)
+            elif isinstance(item, EntranceEditorItem): entrances.append(item)
+            elif isinstance(item, SpriteLocationItem): locations.append(item)
 
 
         b = self.viewbrush
         painter.setPen(QtGui.QPen(QtGui.QColor.fromRgb(0,255,255), 1))
 
-        for zone in Level.zones:
+        for zone in zones:
             x = zone.objx / 16
             y = zone.objy / 16
             width = zone.width / 16
             height = zone.height / 16
             fr(x, y, width, height, b)
             dr(x, y, width, height)
-            if x+width > maxX:
-                maxX = x+width
-            if y+height > maxY:
-                maxY = y+height
 
         b = self.objbrush
 
-        for layer in Level.layers:
-            for obj in layer:
-                fr(obj.LevelRect, b)
-                if obj.objx > maxX:
-                    maxX = obj.objx
-                if obj.objy > maxY:
-                    maxY = obj.objy
+        for obj in objs:
+            fr(obj.LevelRect, b)
 
 
         b = self.spritebrush
 
-        for sprite in Level.sprites:
+        for sprite in sprites:
             fr(sprite.LevelRect, b)
-            if sprite.objx/16 > maxX:
-                maxX = sprite.objx/16
-            if sprite.objy/16 > maxY:
-                maxY = sprite.objy/16
 
 
         b = self.entrancebrush
 
-        for ent in Level.entrances:
+        for ent in entrances:
             fr(ent.LevelRect, b)
-            if ent.objx/16 > maxX:
-                maxX = ent.objx/16
-            if ent.objy/16 > maxY:
-                maxY = ent.objy/16
 
 
         b = self.locationbrush
         painter.setPen(QtGui.QPen(QtCore.Qt.black, 1))
 
-        for location in Level.locations:
+        for location in locations:
             x = location.objx / 16
             y = location.objy / 16
             width = location.width / 16
             height = location.height / 16
             fr(x, y, width, height, b)
             dr(x, y, width, height)
-            if x+width > maxX:
-                maxX = x+width
-            if y+height > maxY:
-                maxY = y+height
-
-        self.maxX = maxX
-        self.maxY = maxY
 
         b = self.locationbrush
         painter.setPen(QtGui.QPen(QtCore.Qt.blue, 1))
@@ -3315,6 +4541,10 @@ class ObjectPickerWidget(QtGui.QListView):
         self.m2.LoadFromTileset(2)
         self.m3.LoadFromTileset(3)
 
+    def LoadFromTileset(self, idx):
+        """Renders the object previews for one tileset"""
+        (self.m0, self.m1, self.m2, self.m3)[idx].LoadFromTileset(idx)
+
     def ShowTileset(self, id):
         """Shows a specific tileset in the picker"""
         sel = self.currentIndex().row()
@@ -3403,8 +4633,6 @@ class ObjectPickerWidget(QtGui.QListView):
 
         def LoadFromTileset(self, idx):
             """Renders all the object previews for the model"""
-            if ObjectDefinitions[idx] == None: return
-
             # begin/endResetModel are only in Qt 4.6...
             if QtCompatVersion >= 0x40600:
                 self.beginResetModel()
@@ -3415,6 +4643,9 @@ class ObjectPickerWidget(QtGui.QListView):
             self.tooltips = []
             defs = ObjectDefinitions[idx]
 
+            # a tileset that's still loading gets filled in later
+            if defs == None: defs = [None]
+
             for i in xrange(256):
                 if defs[i] == None: break
                 obj = RenderObject(idx, i, defs[i].width, defs[i].height, True)
@@ -3424,18 +4655,7 @@ class ObjectPickerWidget(QtGui.QListView):
                 pm.fill(QtCore.Qt.transparent)
                 p = QtGui.QPainter()
                 p.begin(pm)
-                y = 0
-
-                for row in obj:
-                    x = 0
-                    for tile in row:
-                        if tile != -1:
-                            if isinstance(Tiles[tile], QtGui.QImage):
-                                p.drawImage(x, y, Tiles[tile])
-                            else:
-                                p.drawPixmap(x, y, Tiles[tile])
-                        x += 24
-                    y += 24
+                DrawTiles(p, obj)
                 p.end()
 
                 self.ritems.append(pm)
@@ -4469,78 +5689,35 @@ class LevelScene(QtGui.QGraphicsScene):
         painter.fillRect(rect, self.bgbrush)
         if not hasattr(Level, 'layers'): return
 
-        drawrect = QtCore.QRectF(rect.x() / 24, rect.y() / 24, rect.width() / 24 + 1, rect.height() / 24 + 1)
-        #print 'painting ' + repr(drawrect)
-        isect = drawrect.intersects
-
-        layer0 = []; l0add = layer0.append
-        layer1 = []; l1add = layer1.append
-        layer2 = []; l2add = layer2.append
-
-        type_obj = LevelObjectEditorItem
-        ii = isinstance
-
-        x1 = 1024
-        y1 = 512
-        x2 = 0
-        y2 = 0
-
-        # iterate through each object
-        funcs = [layer0.append, layer1.append, layer2.append]
-        show = [ShowLayer0, ShowLayer1, ShowLayer2]
-        for layer, add, process in zip(Level.layers, funcs, show):
-            if not process: continue
-            for item in layer:
-                if not isect(item.LevelRect): continue
-                add(item)
-                xs = item.objx
-                xe = xs+item.width
-                ys = item.objy
-                ye = ys+item.height
-                if xs < x1: x1 = xs
-                if xe > x2: x2 = xe
-                if ys < y1: y1 = ys
-                if ye > y2: y2 = ye
-
-        width = x2 - x1
-        height = y2 - y1
-        tiles = Tiles
-
-        # create and draw the tilemaps
-        for layer in [layer2, layer1, layer0]:
-            if len(layer) > 0:
-                tmap = []
-                i = 0
-                while i < height:
-                    tmap.append([-1] * width)
-                    i += 1
-
-                for item in layer:
-                    startx = item.objx - x1
-                    desty = item.objy - y1
-
-                    for row in item.objdata:
-                        destrow = tmap[desty]
-                        destx = startx
-                        for tile in row:
-                            if tile > 0:
-                                destrow[destx] = tile
-                            destx += 1
-                        desty += 1
-
-                painter.save()
-                painter.translate(x1*24, y1*24)
-                drawPixmap = painter.drawPixmap
-                desty = 0
-                for row in tmap:
-                    destx = 0
-                    for tile in row:
-                        if tile > 0:
-                            r = tiles[tile]
-                            drawPixmap(destx, desty, r)
-                        destx += 24
-                    desty += 24
-                painter.restore()
+        # work out which tiles are inside the rect
+        x1 = max(int(rect.x() / 24), 0)
+        y1 = max(int(rect.y() / 24), 0)
+        x2 = min(int(rect.right() / 24) + 1, 1024)
+        y2 = min(int(rect.bottom() / 24) + 1, 512)
+        if x1 >= x2 or y1 >= y2: return
+
+        chunks = Level.GetChunks()
+        show = (ShowLayer0, ShowLayer1, ShowLayer2)
+        if not (ShowLayer0 or ShowLayer1 or ShowLayer2): return
+
+        # zoomed out views use the smaller copies of the tiles, which are
+        # stretched back over the 384x384 area each chunk covers
+        lod = TileDetail(mainWindow.ZoomLevel)
+
+        # draw whole chunks, clipped to the rect
+        painter.save()
+        painter.setClipRect(rect, QtCore.Qt.IntersectClip)
+        drawPixmap = painter.drawPixmap
+        QRect = QtCore.QRect
+        for cy in xrange(y1 // 16, (y2 - 1) // 16 + 1):
+            for cx in xrange(x1 // 16, (x2 - 1) // 16 + 1):
+                pm = chunks.get(cx, cy, show, lod)
+                if pm == None: continue
+                if lod == 0:
+                    drawPixmap(cx * 384, cy * 384, pm)
+                else:
+                    drawPixmap(QRect(cx * 384, cy * 384, 384, 384), pm)
+        painter.restore()
 
 
 
@@ -4555,7 +5732,8 @@ class LevelViewWidget(QtGui.QGraphicsView):
 
         self.setAlignment(QtCore.Qt.AlignLeft | QtCore.Qt.AlignTop)
         #self.setBackgroundBrush(QtGui.QBrush(QtGui.QColor.fromRgb(119,136,153)))
-        self.setDragMode(QtGui.QGraphicsView.RubberBandDrag)
+        # the rubber band is done here instead, so it can use the level's index
+        self.setDragMode(QtGui.QGraphicsView.NoDrag)
         #self.setDragMode(QtGui.QGraphicsView.ScrollHandDrag)
         self.setMouseTracking(True)
         #self.setOptimizationFlags(QtGui.QGraphicsView.IndirectPainting)
@@ -4565,6 +5743,8 @@ class LevelViewWidget(QtGui.QGraphicsView):
         self.setHorizontalScrollBar(self.XScrollBar)
 
         self.currentobj = None
+        self.rubberband = QtGui.QRubberBand(QtGui.QRubberBand.Rectangle, self.viewport())
+        self.bandstart = None
 
     def mousePressEvent(self, event):
         """Overrides mouse pressing events if needed"""
@@ -4586,6 +5766,7 @@ class LevelViewWidget(QtGui.QGraphicsView):
 
                 obj = LevelObjectEditorItem(CurrentPaintType, CurrentObject, ln, clickedx, clickedy, 1, 1, z)
                 layer.append(obj)
+                Level.UpdateTilemap(obj)
                 mw = mainWindow
                 obj.positionChanged = mw.HandleObjPosChange
                 mw.scene.addItem(obj)
@@ -4812,6 +5993,13 @@ class LevelViewWidget(QtGui.QGraphicsView):
 
         else:
             QtGui.QGraphicsView.mousePressEvent(self, event)
+
+            if event.button() == QtCore.Qt.LeftButton and not event.isAccepted():
+                # nothing was clicked, so start a rubber band
+                self.bandstart = event.pos()
+                self.rubberband.setGeometry(QtCore.QRect(self.bandstart, QtCore.QSize()))
+                self.rubberband.show()
+                event.accept()
         mainWindow.levelOverview.update()
 
 
@@ -4871,7 +6059,8 @@ class LevelViewWidget(QtGui.QGraphicsView):
                     height = dsy - clicky + 1
 
                 # if the position changed, set the new one
-                if cx != x or cy != y:
+                moved = cx != x or cy != y
+                if moved:
                     obj.objx = x
                     obj.objy = y
                     obj.setPos(x * 24, y * 24)
@@ -4880,15 +6069,30 @@ class LevelViewWidget(QtGui.QGraphicsView):
                 if cwidth != width or cheight != height:
                     obj.width = width
                     obj.height = height
-                    obj.updateObjCache()
 
-                    oldrect = obj.BoundingRect
-                    oldrect.translate(cx * 24, cy * 24)
-                    newrect = QtCore.QRectF(obj.x(), obj.y(), obj.width * 24, obj.height * 24)
-                    updaterect = oldrect.unite(newrect)
+                    if moved:
+                        # the whole object shifted, so it's drawn again
+                        obj.updateObjCache()
 
-                    obj.UpdateRects()
-                    obj.scene().update(updaterect)
+                        oldrect = obj.BoundingRect
+                        oldrect.translate(cx * 24, cy * 24)
+                        newrect = QtCore.QRectF(obj.x(), obj.y(), obj.width * 24, obj.height * 24)
+                        updaterect = oldrect.unite(newrect)
+
+                        obj.UpdateRects()
+                        obj.scene().update(updaterect)
+                        Level.UpdateTilemap(obj)
+                    else:
+                        # only the strips that changed are drawn again
+                        changed = obj.resizeObjCache(cwidth, cheight)
+                        Level.UpdateTilemap(obj, changed)
+
+                        obj.UpdateRects()
+                        for rect in changed:
+                            obj.scene().update(TileRectToScene(rect))
+
+                elif moved:
+                    Level.UpdateTilemap(obj)
 
             elif isinstance(obj, type_loc):
                 # resize/move the current location
@@ -4982,6 +6186,11 @@ class LevelViewWidget(QtGui.QGraphicsView):
                     obj.objy = clickedy
                     obj.setPos(int(clickedx * 1.5), int(clickedy * 1.5))
             event.accept()
+        elif self.bandstart != None:
+            rect = QtCore.QRect(self.bandstart, event.pos()).normalized()
+            self.rubberband.setGeometry(rect)
+            self.SelectInRect(self.mapToScene(rect).boundingRect())
+            event.accept()
         else:
             QtGui.QGraphicsView.mouseMoveEvent(self, event)
 
@@ -4991,10 +6200,38 @@ class LevelViewWidget(QtGui.QGraphicsView):
         if event.button() == QtCore.Qt.RightButton:
             self.currentobj = None
             event.accept()
+        elif event.button() == QtCore.Qt.LeftButton and self.bandstart != None:
+            self.bandstart = None
+            self.rubberband.hide()
+            event.accept()
         else:
             QtGui.QGraphicsView.mouseReleaseEvent(self, event)
 
 
+    def SelectInRect(self, rect):
+        """Selects the items overlapping a rect of the scene, and nothing
+        else, using the level's index to find them"""
+        found = Level.GetItemIndex().query(rect.left(), rect.top(), rect.right(), rect.bottom())
+        selectable = QtGui.QGraphicsItem.ItemIsSelectable
+        wanted = set([item for item in found if item.isVisible() and (int(item.flags()) & selectable) != 0])
+
+        # only update the panels once at the end
+        mw = mainWindow
+        mw.SelectionUpdateFlag = True
+        changed = False
+        for item in self.scene().selectedItems():
+            if item not in wanted:
+                item.setSelected(False)
+                changed = True
+        for item in wanted:
+            if not item.isSelected():
+                item.setSelected(True)
+                changed = True
+        mw.SelectionUpdateFlag = False
+
+        if changed: mw.ChangeSelectionHandler()
+
+
     def drawForeground(self, painter, rect):
         """Draws a grid"""
         if not GridEnabled: return
@@ -6461,6 +7698,9 @@ class ReggieWindow(QtGui.QMainWindow):
         self.view.YScrollBar.valueChanged.connect(self.YScrollChange)
         self.view.FrameSize.connect(self.HandleWindowSizeChange)
 
+        # tilesets loaded in the background show up as they finish
+        TilesetQueue.TilesetLoaded.connect(self.HandleTilesetLoaded)
+
         # done creating the window!
         self.setCentralWidget(self.view)
 
@@ -7042,9 +8282,7 @@ class ReggieWindow(QtGui.QMainWindow):
     @QtCore.pyqtSlot()
     def SelectAll(self):
         """Selects all objects in the level"""
-        paintRect = QtGui.QPainterPath()
-        paintRect.addRect(float(0), float(0), float(1024*24), float(512*24))
-        self.scene.setSelectionArea(paintRect)
+        self.view.SelectInRect(QtCore.QRectF(0, 0, 1024*24, 512*24))
 
 
     @QtCore.pyqtSlot()
@@ -7290,8 +8528,14 @@ class ReggieWindow(QtGui.QMainWindow):
             if func_ii(item, type_spr):
                 item.setPos((item.objx + xpixeloffset + item.xoffset) * 1.5, (item.objy + ypixeloffset + item.yoffset) * 1.5)
             elif func_ii(item, type_obj):
+                oldx = item.objx
+                oldy = item.objy
                 item.setPos((item.objx + xoffset) * 24, (item.objy + yoffset) * 24)
 
+                # itemChange only puts objects that moved into the tilemap
+                if item.objx == oldx and item.objy == oldy:
+                    Level.UpdateTilemap(item)
+
         OverrideSnapping = False
 
         self.levelOverview.update()
@@ -7432,52 +8676,24 @@ class ReggieWindow(QtGui.QMainWindow):
         fn = QtGui.QFileDialog.getOpenFileName(self, 'Choose a level archive', '', 'Level archives (*.arc);;All Files(*)')
         if fn == '': return
 
-        getit = open(unicode(fn), 'rb')
-        arcdata = getit.read()
-        getit.close()
-
-        arc = archive.U8.load(arcdata)
-
-        # get the area count
-        areacount = 0
-
-        for item,val in arc.files:
-            if val != None:
-                # it's a file
-                fname = item[item.rfind('/')+1:]
-                if fname.startswith('course'):
-                    maxarea = int(fname[6])
-                    if maxarea > areacount: areacount = maxarea
+        # map the archive; only the chosen area's files are read from it
+        arc = archive.U8.loadFile(unicode(fn), lazy=True)
 
         # choose one
-        dlg = AreaChoiceDialog(areacount)
+        dlg = AreaChoiceDialog(CountAreas(arc))
         if dlg.exec_() == QtGui.QDialog.Rejected:
+            arc.close()
             return
 
         area = dlg.areaCombo.currentIndex()+1
 
         # get the required files
-        reqcourse = 'course%d.bin' % area
-        reql0 = 'course%d_bgdatL0.bin' % area
-        reql1 = 'course%d_bgdatL1.bin' % area
-        reql2 = 'course%d_bgdatL2.bin' % area
-
-        course = None
-        l0 = None
-        l1 = None
-        l2 = None
-
-        for item,val in arc.files:
-            if val != None:
-                fname = item[item.rfind('/')+1:]
-                if fname == reqcourse:
-                    course = val
-                elif fname == reql0:
-                    l0 = val
-                elif fname == reql1:
-                    l1 = val
-                elif fname == reql2:
-                    l2 = val
+        course = arc.get('course/course%d.bin' % area)
+        l0 = arc.get('course/course%d_bgdatL0.bin' % area)
+        l1 = arc.get('course/course%d_bgdatL1.bin' % area)
+        l2 = arc.get('course/course%d_bgdatL2.bin' % area)
+
+        arc.close()
 
         # add them to our U8
         newID = Level.areacount + 1
@@ -7500,31 +8716,21 @@ class ReggieWindow(QtGui.QMainWindow):
 
         # this is really going to be annoying >_<
         deleting = Level.areanum
-
-        newfiles = []
-        for item,val in Level.arc.files:
-            if val != None:
-                if item.startswith('course/course'):
-                    id = int(item[13])
-                    if id < deleting:
-                        # pass it through anyway
-                        newfiles.append((item,val))
-                    elif id == deleting:
-                        # remove it
-                        continue
-                    else:
-                        # push the number down by one
-                        fname = 'course/course%d%s' % (id - 1, item[14:])
-                        newfiles.append((fname,val))
-            else:
-                newfiles.append((item,val))
-
-        Level.arc.files = newfiles
+        arc = Level.arc
+
+        # sorted, so each area is pushed down after the one below it is out of the way
+        for fname in sorted(arc.listdir('course')):
+            if not fname.startswith('course'): continue
+            id = int(fname[6])
+            if id == deleting:
+                # remove it
+                del arc['course/' + fname]
+            elif id > deleting:
+                # push the number down by one
+                arc.rename('course/' + fname, 'course/course%d%s' % (id - 1, fname[7:]))
 
         # no error checking. if it saved last time, it will probably work now
-        f = open(Level.arcname, 'wb')
-        f.write(Level.arc._dump())
-        f.close()
+        Level.WriteArchive()
         self.LoadLevel(Level.arcname, True, 1)
 
 
@@ -7589,11 +8795,9 @@ class ReggieWindow(QtGui.QMainWindow):
             return
 
         global Dirty, AutoSaveDirty
-        data = Level.save()
+        Level.SaveArchive()
         try:
-            f = open(Level.arcname, 'wb')
-            f.write(data)
-            f.close()
+            Level.WriteArchive()
         except IOError, e:
             QtGui.QMessageBox.warning(None, 'Error', 'Error while Reggie was trying to save the level:\n(#%d) %s\n\n(Your work has not been saved! Try saving it under a different filename or in a different folder.)' % (e.args[0], e.args[1]))
             return False
@@ -7623,10 +8827,8 @@ class ReggieWindow(QtGui.QMainWindow):
         Level.filename = os.path.basename(fn)
         Level.hasName = True
 
-        data = Level.save()
-        f = open(fn, 'wb')
-        f.write(data)
-        f.close()
+        Level.SaveArchive()
+        Level.WriteArchive()
         settings.setValue('AutoSaveFilePath', fn)
         settings.setValue('AutoSaveFileData', 'x')
 
@@ -8070,6 +9272,26 @@ class ReggieWindow(QtGui.QMainWindow):
         return True
 
 
+    @QtCore.pyqtSlot(int)
+    def HandleTilesetLoaded(self, idx):
+        """Redraws everything using a tileset that just finished loading"""
+        self.objPicker.LoadFromTileset(idx)
+        if not hasattr(Level, 'layers'): return
+
+        # only the tiles of objects from this tileset need to be redrawn
+        changed = []
+        for layer in Level.layers:
+            for obj in layer:
+                if obj.tileset == idx:
+                    obj.updateObjCache()
+                    changed.append(obj)
+
+        Level.RefreshTilemaps(changed)
+
+        self.scene.update()
+        self.levelOverview.update()
+
+
     @QtCore.pyqtSlot()
     def ReloadTilesets(self):
         tilesets = [Level.tileset0, Level.tileset1, Level.tileset2, Level.tileset3]
@@ -8083,6 +9305,7 @@ class ReggieWindow(QtGui.QMainWindow):
             for obj in layer:
                 obj.updateObjCache()
 
+        Level.InvalidateTilemaps()
         self.scene.update()
 
 
@@ -8256,6 +9479,7 @@ class ReggieWindow(QtGui.QMainWindow):
                     item.setZValue(z)
                     item.setVisible(newVisibility)
                     item.update()
+                    level.UpdateTilemap(item)
                     z += 1
 
             self.scene.update()
@@ -8566,6 +9790,7 @@ class ReggieWindow(QtGui.QMainWindow):
                 for obj in layer:
                     obj.updateObjCache()
 
+            Level.InvalidateTilemaps()
             self.scene.update()
 
     @QtCore.pyqtSlot()
@@ -9000,6 +10225,22 @@ def main():
     PathsNonFrozen = (settings.value('FreezePaths', 'false').toPyObject() == 'false')
     LocationsNonFrozen = (settings.value('FreezeLocations', 'false').toPyObject() == 'false')
 
+    # memory budget for recently used tilesets, in MB
+    global TilesetMemory
+    budget, ok = settings.value('TilesetCacheSize', 64).toInt()
+    if not ok: budget = 64
+    TilesetMemory = TilesetCache(budget * 1048576)
+
+    global TilesetQueue, TilesetCacheDir
+    TilesetCacheDir = TilesetCachePath()
+    TilesetQueue = TilesetLoader()
+
+    # memory budget for pre-rendered parts of the level, in MB
+    global TileChunkMemory
+    budget, ok = settings.value('TileChunkCacheSize', 128).toInt()
+    if not ok: budget = 128
+    TileChunkMemory = budget * 1048576
+
     if settings.contains('GamePath'):
         SetGamePath(settings.value('GamePath').toPyObject())
 
@@ -9047,16 +10288,16 @@ EnableAlpha = True
 if '-alpha' in sys.argv:
     EnableAlpha = False
 
-    # nsmblib doesn't support -alpha so if it's enabled
-    # then don't use it
-    HaveNSMBLib = False
-
 # check version
 if HaveNSMBLib:
     version = nsmblib.getVersion()
     if version < 4:
         HaveNSMBLib = False
 
+    # nsmblib only supports -alpha from 0.8 onwards
+    if not EnableAlpha and version < 8:
+        HaveNSMBLib = False
+
 if '-nolib' in sys.argv:
     HaveNSMBLib = False
 
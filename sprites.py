@@ -4045,7 +4045,7 @@ def PaintAlphaObject(sprite, painter):
 def PaintBlock(sprite, painter):
     painter.setRenderHint(QtGui.QPainter.Antialiasing)
     if Tiles[sprite.tilenum] != None:
-        painter.drawPixmap(0, 0, Tiles[sprite.tilenum])
+        Tiles[sprite.tilenum].draw(painter, 0, 0)
     painter.drawPixmap(0, 0, sprite.image)
 
 def PaintWoodenPlatform(sprite, painter):